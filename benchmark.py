@@ -0,0 +1,415 @@
+import os
+import logging
+
+# Log records are still created and formatted like in the app, but a benchmark run stays out of executed_commands.log
+logging.basicConfig(level=logging.DEBUG, filename=os.devnull)
+
+import re
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import platform
+import threading
+import statistics
+import httpx
+from typing import Callable, Iterator
+from itertools import islice, accumulate
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from mistralai.models import ChatCompletionResponse, ChatCompletionChoice, UsageInfo, AssistantMessage, UserMessage, ToolMessage, ToolCall, FunctionCall
+from main import (Librarian, ConnectionManager, QueryCache, AuthorizationSession, Mistral_Ai, LibraryServer, READ_ONLY_TOOLS, TOOLS_JSON,
+                  BULK_LOAD_CHUNK_SIZE, BULK_LOAD_PRAGMAS, STORAGE_DATE_FORMAT, DISPLAY_DATE_FORMAT, fetch_rows)
+
+SCALES = {
+    "small": {"books": 10_000, "users": 10_000, "rentals": 100_000},
+    "medium": {"books": 100_000, "users": 100_000, "rentals": 1_000_000},
+    "large": {"books": 1_000_000, "users": 100_000, "rentals": 10_000_000},
+}
+ID_ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyz"
+ID_SPACE = 36 ** 8
+ID_MULTIPLIER = 2_654_435_761  # prime, so i -> i * m mod 36**8 is a bijection and IDs never collide
+ACTIVE_RENTAL_RATIO = 0.03
+RENTAL_HISTORY_DAYS = 730
+REGRESSION_TOLERANCE = 0.25
+
+TITLE_WORDS = ("Quantum", "Crimson", "Silent", "Gilded", "Hidden", "Last", "Broken", "Eternal", "Midnight", "Sapphire",
+               "Iron", "Forgotten", "Burning", "Hollow", "Starlit", "Shattered", "Velvet", "Wandering", "Frozen", "Golden")
+TITLE_NOUNS = ("Paradox", "Cipher", "Kingdom", "Alchemist", "Odyssey", "Cage", "Garden", "Empire", "Library", "Voyage",
+               "Serpent", "Crown", "Harbor", "Archive", "Tide", "Oracle", "Labyrinth", "Compass", "Lantern", "Citadel")
+TITLE_PLACES = ("Eldoria", "the Void", "the North", "Avalon", "the Deep", "Morrow", "the Stars", "Veridia", "Ashfall", "Dawn")
+FIRST_NAMES = ("Evelyn", "Gideon", "Silas", "Aria", "Julien", "Kaelen", "Lila", "Isolde", "Helena", "Marcus",
+               "Nora", "Theo", "Elena", "Felix", "Maya", "Oscar", "Clara", "Hugo", "Iris", "Leon")
+LAST_NAMES = ("Reed", "Ashworth", "Blackwood", "Vance", "Croft", "Rourke", "Summers", "Verne", "Faye", "Graves",
+              "Holloway", "Sterling", "Marlowe", "Whitaker", "Thorne", "Castillo", "Novak", "Okafor", "Lindqvist", "Moreau")
+
+
+def synthetic_id(prefix: str, index: int) -> str:
+    value = (index * ID_MULTIPLIER) % ID_SPACE
+    chars = []
+    for _ in range(8):
+        value, digit = divmod(value, 36)
+        chars.append(ID_ALPHABET[digit])
+    return f"{prefix}_{''.join(chars)}"
+
+
+def synthetic_books(count: int, rng: random.Random) -> Iterator[dict]:
+    for index in range(count):
+        title = f"The {rng.choice(TITLE_WORDS)} {rng.choice(TITLE_NOUNS)}"
+        if rng.random() < 0.5:
+            title += f" of {rng.choice(TITLE_PLACES)}"
+        yield {"book_id": synthetic_id("book", index), "title": title,
+               "author": f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+               "isbn": f"978-{index // 10_000_000 % 10}-{index // 10_000 % 1000:03d}-{index % 10_000:04d}-{index % 7}",
+               "quantity": rng.randint(0, 10), "amount_of_times_rented": rng.randint(0, 200)}
+
+
+def synthetic_users(count: int, rng: random.Random) -> Iterator[tuple]:
+    for index in range(count):
+        yield (synthetic_id("user", index), f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+               rng.choice(("male", "female")), rng.randint(8, 90))
+
+
+def synthetic_rentals(count: int, books: int, users: int, rng: random.Random) -> Iterator[tuple]:
+    today = date.today()
+    for index in range(count):
+        rented = today - timedelta(days=rng.randint(0, RENTAL_HISTORY_DAYS))
+        returned = None
+        if rng.random() >= ACTIVE_RENTAL_RATIO:
+            returned = min(today, rented + timedelta(days=rng.randint(1, 30))).strftime(STORAGE_DATE_FORMAT)
+        yield (synthetic_id("rent", index), synthetic_id("user", rng.randrange(users)),
+               synthetic_id("book", rng.randrange(books)), rented.strftime(STORAGE_DATE_FORMAT), returned)
+
+
+def bulk_insert(conn: sqlite3.Connection, sql: str, rows: Iterator[tuple]) -> int:
+    saved_pragmas = {name: conn.execute(f"PRAGMA {name}").fetchone()[0] for name in BULK_LOAD_PRAGMAS}
+    for name, value in BULK_LOAD_PRAGMAS.items():
+        conn.execute(f"PRAGMA {name} = {value}")
+    inserted = 0
+    try:
+        while chunk := list(islice(rows, BULK_LOAD_CHUNK_SIZE)):
+            conn.executemany(sql, chunk)
+            conn.commit()
+            inserted += len(chunk)
+    finally:
+        for name, value in saved_pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+    return inserted
+
+
+def generate_library(librarian: Librarian, books: int, users: int, rentals: int, seed: int) -> float:
+    rng = random.Random(seed)
+    started = time.perf_counter()
+    librarian._bulk_load_books(synthetic_books(books, rng), source="synthetic")
+    bulk_insert(librarian.conn, "INSERT INTO users (user_id, full_name, gender, age) VALUES (?, ?, ?, ?)",
+                synthetic_users(users, rng))
+    bulk_insert(librarian.conn, "INSERT INTO rentals (rental_id, user_id, book_id, rental_date, return_date) VALUES (?, ?, ?, ?, ?)",
+                synthetic_rentals(rentals, books, users, rng))
+    librarian.conn.execute("ANALYZE")
+    librarian.conn.commit()
+    return time.perf_counter() - started
+
+
+class UnattendedAuth(AuthorizationSession):
+    # The benchmark measures the SQL, not a human typing the admin password
+    def authorize(self, description: str) -> bool:
+        return True
+
+
+class ScriptedMistral:
+    """Stands in for the Mistral client, replaying one scripted list of tool-call rounds per user prompt."""
+
+    def __init__(self, script: list[list[tuple[str, dict]]], latency: float = 0.0):
+        self.script: list[list[tuple[str, dict]]] = script
+        self.latency: float = latency
+        self.calls: int = 0
+        self._round_ends: list[int] = list(accumulate(len(round_) for round_ in script))
+        self._lock = threading.Lock()
+        self.chat = self
+
+    def complete(self, messages: list, **kwargs) -> ChatCompletionResponse:
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls += 1
+            call = self.calls
+        # The round is read off the conversation itself, so one client can serve many sessions at once
+        tools_answered = 0
+        for message in reversed(messages):
+            if isinstance(message, UserMessage):
+                break
+            tools_answered += isinstance(message, ToolMessage)
+        round_ = sum(end <= tools_answered for end in self._round_ends)
+        if round_ < len(self.script):
+            tool_calls = [ToolCall(id=f"call_{call}_{index}", function=FunctionCall(name=name, arguments=json.dumps(arguments)))
+                          for index, (name, arguments) in enumerate(self.script[round_])]
+            message = AssistantMessage(content="", tool_calls=tool_calls)
+        else:
+            message = AssistantMessage(content="Done.")
+        return ChatCompletionResponse(id=f"bench_{call}", object="chat.completion", model="scripted", created=0,
+                                      usage=UsageInfo(prompt_tokens=0, completion_tokens=0, total_tokens=0),
+                                      choices=[ChatCompletionChoice(index=0, message=message, finish_reason="stop")])
+
+
+class Benchmark:
+    def __init__(self, iterations: int, seed: int):
+        self.iterations: int = iterations
+        # Sampling gets its own generator, seeding the global one would make the app's random IDs repeat between runs
+        self.rng: random.Random = random.Random(seed)
+        self.results: dict[str, dict[str, float]] = {}
+
+    def measure(self, name: str, operation: Callable[[int], object], iterations: int | None = None, setup: Callable[[], None] | None = None) -> None:
+        timings: list[float] = []
+        for index in range(self.iterations if iterations is None else iterations):
+            if setup:
+                setup()
+            started = time.perf_counter()
+            operation(index)
+            timings.append(time.perf_counter() - started)
+        if not timings:
+            print(f"{name:<32} skipped, nothing to run")
+            return None
+        self.results[name] = summarise(timings)
+        print(f"{name:<32} p50 {self.results[name]['p50_ms']:>10.3f} ms   p95 {self.results[name]['p95_ms']:>10.3f} ms   "
+              f"({self.results[name]['count']} runs)")
+        return None
+
+
+def summarise(timings: list[float]) -> dict[str, float]:
+    ordered = sorted(timings)
+    percentile = lambda fraction: ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+    total = sum(ordered)
+    return {"count": len(ordered), "mean_ms": round(1000 * statistics.fmean(ordered), 4),
+            "p50_ms": round(1000 * percentile(0.5), 4), "p95_ms": round(1000 * percentile(0.95), 4),
+            "max_ms": round(1000 * ordered[-1], 4), "ops_per_sec": round(len(ordered) / total, 2) if total else None}
+
+
+def sample_ids(librarian: Librarian, table: str, column: str, count: int, rng: random.Random, where: str = "1") -> list[str]:
+    # random() over a multi-million row table is slow, sampling rowids keeps setup cheap
+    max_rowid = librarian.conn.execute(f"SELECT max(rowid) FROM {table}").fetchone()[0] or 0
+    rowids = [rng.randint(1, max_rowid) for _ in range(count * 4)] if max_rowid else []
+    ids = []
+    for start in range(0, len(rowids), 500):
+        chunk = rowids[start:start + 500]
+        ids += [row[0] for row in librarian.conn.execute(
+            f"SELECT {column} FROM {table} WHERE rowid IN ({', '.join('?' * len(chunk))}) AND {where}", chunk)]
+    return ids[:count]
+
+
+def run_librarian_benchmarks(bench: Benchmark, librarian: Librarian, format_rows: int) -> None:
+    today = date.today().strftime(DISPLAY_DATE_FORMAT)
+    users = sample_ids(librarian, "users", "user_id", bench.iterations, bench.rng)
+    books = sample_ids(librarian, "books", "book_id", bench.iterations, bench.rng, where="quantity > 0")
+    if not users or not books:
+        raise SystemExit("The benchmark database has no users or no books in stock.")
+
+    rental_ids: list[str] = []
+    def rent(index: int) -> None:
+        message = librarian.add_rental(users[index % len(users)], books[index % len(books)], today)
+        if match := re.search(r"'(rent_\w+)'", message):
+            rental_ids.append(match.group(1))
+    bench.measure("add_rental", rent)
+    bench.measure("return_book", lambda index: librarian.return_book(rental_ids[index], today), iterations=len(rental_ids))
+
+    join_query = '''
+        SELECT r.rental_id, b.title, b.author, r.rental_date, r.return_date
+        FROM rentals r JOIN books b ON b.book_id = r.book_id
+        WHERE r.user_id = ?
+        ORDER BY r.rental_date DESC
+    '''
+    # The cache would turn every repeat into a dictionary lookup, time the cold path and the hit separately
+    bench.measure("fetch_data_join_cold", lambda index: librarian.fetch_data(join_query, (users[index % len(users)],)),
+                  setup=lambda: librarian._cache.invalidate(None))
+    bench.measure("fetch_data_join_cached", lambda index: librarian.fetch_data(join_query, (users[0],)))
+    active_query = '''
+        SELECT r.rental_id, u.full_name, b.title, r.rental_date
+        FROM rentals r JOIN users u ON u.user_id = r.user_id JOIN books b ON b.book_id = r.book_id
+        WHERE r.return_date IS NULL AND r.book_id = ?
+    '''
+    bench.measure("fetch_data_active_by_book", lambda index: librarian.fetch_data(active_query, (books[index % len(books)],)),
+                  setup=lambda: librarian._cache.invalidate(None))
+
+    # The renter lookup of the rental workflow, with a dropped letter as a typed-in name would have
+    names = sample_ids(librarian, "users", "full_name", bench.iterations, bench.rng)
+    bench.measure("find_user", lambda index: librarian.find_user(names[index % len(names)]))
+    bench.measure("find_user_typo", lambda index: librarian.find_user(names[index % len(names)][:-2] + names[index % len(names)][-1]))
+
+    batch = [("UPDATE books SET amount_of_times_rented = amount_of_times_rented + 0 WHERE book_id = ?", (book_id,)) for book_id in books]
+    bench.measure("mass_execute_batch", lambda index: librarian.mass_execute(batch), iterations=max(3, bench.iterations // 20))
+
+    with librarian._connections.reader() as conn:
+        columns, rows = fetch_rows(conn.execute("SELECT rental_id, user_id, book_id, rental_date, return_date FROM rentals LIMIT ?", (format_rows,)))
+    bench.measure(f"format_rows_{len(rows)}", lambda index: Librarian._format_rows_to_string(rows, columns), iterations=max(3, bench.iterations // 20))
+
+    def fetch_and_format(index: int) -> None:
+        with librarian._connections.reader() as conn:
+            fetched_columns, fetched = fetch_rows(conn.execute(
+                "SELECT rental_id, user_id, book_id, rental_date, return_date FROM rentals LIMIT ?", (format_rows,)))
+        Librarian._format_rows_to_string(fetched, fetched_columns)
+    bench.measure(f"fetch_format_rows_{len(rows)}", fetch_and_format, iterations=max(3, bench.iterations // 20))
+    return None
+
+
+def dispatch_script(users: list[str]) -> list[list[tuple[str, dict]]]:
+    script = [
+        [("search_books", {"query": "quantum paradox", "limit": 5}),
+         ("fetch_data", {"prompt": "SELECT * FROM rentals WHERE user_id = ? AND return_date IS NULL", "params": users})],
+        [("get_overdue_rentals", {"loan_days": 30})],
+    ]
+    # Read-only rounds go through the reader pool, so the scripted rounds must stay read-only to be repeatable
+    assert all(name in READ_ONLY_TOOLS for round_ in script for name, _ in round_)
+    return script
+
+
+def read_only_engine(librarian: Librarian) -> Mistral_Ai:
+    schemas = [tool for tool in TOOLS_JSON if tool["function"]["name"] in READ_ONLY_TOOLS]
+    return Mistral_Ai("benchmark", "scripted", "You are a benchmark.", schemas, sorted(READ_ONLY_TOOLS), librarian=librarian)
+
+
+def check_tool_results(messages: list) -> None:
+    # A rejected call still completes the turn, so a broken script would otherwise time the error path
+    for message in messages:
+        if isinstance(message, ToolMessage) and str(message.content).startswith(('{"error"', "Error")):
+            raise RuntimeError(f"Scripted tool call {message.name} failed: {message.content}")
+    return None
+
+
+def run_server_load(bench: Benchmark, librarian: Librarian, concurrency: int, latency: float) -> dict:
+    users = sample_ids(librarian, "users", "user_id", 1, bench.rng)
+    engine = read_only_engine(librarian)
+    # Not entered as a context manager, leaving would close the librarian the dispatch benchmark still needs
+    engine._initilise_clients()
+    engine._client = ScriptedMistral(dispatch_script(users), latency)
+    server = LibraryServer(engine, "127.0.0.1", 0)
+    host, port = server.address
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    chat_timings, tool_timings, statuses, lock = [], [], {}, threading.Lock()
+    def client(worker: int) -> None:
+        with httpx.Client(base_url=f"http://{host}:{port}", timeout=60.0) as http:
+            session_id = http.post("/sessions").json()["session_id"]
+            for index in range(max(1, bench.iterations // concurrency)):
+                for timings, path, body in ((chat_timings, f"/sessions/{session_id}/messages", {"content": f"What is overdue? ({worker}.{index})"}),
+                                            (tool_timings, "/tools/search_books", {"query": "quantum", "limit": 5})):
+                    started = time.perf_counter()
+                    response = http.post(path, json=body)
+                    elapsed = time.perf_counter() - started
+                    with lock:
+                        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+                        if response.status_code == 200:
+                            timings.append(elapsed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as clients:
+        list(clients.map(client, range(concurrency)))
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+    engine._reader_pool.shutdown(wait=True)
+
+    for name, timings in (("server_chat_turn", chat_timings), ("server_tool_call", tool_timings)):
+        if timings:
+            bench.results[name] = summarise(timings)
+            print(f"{name:<32} p50 {bench.results[name]['p50_ms']:>10.3f} ms   p95 {bench.results[name]['p95_ms']:>10.3f} ms   "
+                  f"({bench.results[name]['count']} runs)")
+    requests = sum(statuses.values())
+    print(f"{'server_throughput':<32} {requests / elapsed:>10.1f} req/s with {concurrency} clients, statuses {statuses}")
+    return {"concurrency": concurrency, "requests_per_sec": round(requests / elapsed, 1), "statuses": statuses}
+
+
+def run_dispatch_benchmarks(bench: Benchmark, librarian: Librarian, latency: float) -> None:
+    users = sample_ids(librarian, "users", "user_id", 1, bench.rng)
+    client = ScriptedMistral(dispatch_script(users), latency)
+    mist = read_only_engine(librarian)
+    with mist:
+        mist._client = client
+        def turn(index: int) -> None:
+            librarian._cache.invalidate(None)
+            mist._messages_sent = mist._messages_sent[:1]
+            mist.text_gen(f"Which books does {users[0]} have and what is overdue? ({index})")
+            check_tool_results(mist._messages_sent)
+        bench.measure("text_gen_tool_loop", turn)
+    return None
+
+
+def compare_with_baseline(results: dict[str, dict[str, float]], baseline_path: str, tolerance: float) -> list[str]:
+    with open(baseline_path, encoding="utf-8") as file:
+        baseline = json.load(file)["results"]
+    regressions = []
+    print(f"\n{'operation':<32} {'baseline p50':>14} {'current p50':>14} {'change':>9}")
+    for name, current in results.items():
+        if name not in baseline or not baseline[name]["p50_ms"]:
+            print(f"{name:<32} {'-':>14} {current['p50_ms']:>11.3f} ms {'new':>9}")
+            continue
+        change = current["p50_ms"] / baseline[name]["p50_ms"] - 1
+        flag = "  REGRESSION" if change > tolerance else ""
+        print(f"{name:<32} {baseline[name]['p50_ms']:>11.3f} ms {current['p50_ms']:>11.3f} ms {change:>+8.1%}{flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the Librarian and the tool-dispatch loop against a synthetic library.")
+    parser.add_argument("--scale", choices=SCALES, default="small", help="preset library size (large is 1M books, 100k users, 10M rentals)")
+    parser.add_argument("--books", type=int, help="override the number of books for the chosen scale")
+    parser.add_argument("--users", type=int, help="override the number of users for the chosen scale")
+    parser.add_argument("--rentals", type=int, help="override the number of rentals for the chosen scale")
+    parser.add_argument("--database", default=None, help="database file to use (default: bench_<scale>.db)")
+    parser.add_argument("--regenerate", action="store_true", help="rebuild the database even if it already exists")
+    parser.add_argument("--iterations", type=int, default=200, help="timed runs per operation")
+    parser.add_argument("--format-rows", type=int, default=100_000, help="result-set size for the _format_rows_to_string run")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="seconds the mock Mistral client sleeps per request")
+    parser.add_argument("--server-load", type=int, default=0, metavar="CLIENTS",
+                        help="also load-test the HTTP server mode with this many concurrent clients")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", default=None, help="write the JSON results to this file")
+    parser.add_argument("--baseline", default=None, help="compare p50 timings against a previous --output file")
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE, help="p50 slowdown that counts as a regression")
+    args = parser.parse_args(argv)
+
+    size = {name: getattr(args, name) or count for name, count in SCALES[args.scale].items()}
+    database = args.database or f"bench_{args.scale}.db"
+    if args.regenerate and os.path.exists(database):
+        os.remove(database)
+    fresh = not os.path.exists(database)
+
+    bench = Benchmark(args.iterations, args.seed)
+    librarian = Librarian(ConnectionManager(database=database), QueryCache(), UnattendedAuth())
+    generation_seconds = None
+    if fresh:
+        print(f"Generating {size['books']:,} books, {size['users']:,} users and {size['rentals']:,} rentals into {database}...")
+        generation_seconds = round(generate_library(librarian, size["books"], size["users"], size["rentals"], args.seed), 2)
+        print(f"Generated in {generation_seconds:.1f}s\n")
+    else:
+        size = {table: librarian.conn.execute(f"SELECT count(*) FROM {table}").fetchone()[0] for table in ("books", "users", "rentals")}
+        print(f"Reusing {database} ({size['books']:,} books, {size['users']:,} users, {size['rentals']:,} rentals)\n")
+
+    run_librarian_benchmarks(bench, librarian, args.format_rows)
+    server_load = run_server_load(bench, librarian, args.server_load, args.llm_latency) if args.server_load > 0 else None
+    # Mistral_Ai closes the librarian on exit, so the dispatch loop runs last
+    run_dispatch_benchmarks(bench, librarian, args.llm_latency)
+
+    report = {"meta": {"scale": args.scale, **size, "iterations": args.iterations, "llm_latency": args.llm_latency,
+                       "generation_seconds": generation_seconds, "server_load": server_load, "python": platform.python_version(),
+                       "sqlite": sqlite3.sqlite_version, "platform": platform.platform(),
+                       "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")},
+              "results": bench.results}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+        print(f"\nResults written to {args.output}")
+    else:
+        print(f"\n{json.dumps(report, indent=2)}")
+
+    if args.baseline:
+        regressions = compare_with_baseline(bench.results, args.baseline, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} operation(s) slower than the baseline by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,122 +7,1763 @@ import os
 from dotenv import load_dotenv
 import logging
 from mistralai import Mistral
-from mistralai.models import UserMessage, SystemMessage, AssistantMessage, ToolMessage
+from mistralai.models import UserMessage, SystemMessage, AssistantMessage, ToolMessage, ToolCall, FunctionCall, SDKError
 from functools import partial
 import json
 from getpass import getpass
 import bcrypt
-from datetime import datetime
+from datetime import datetime, timedelta
 import httpx
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import time
+import argparse
+from itertools import islice
+from typing import Iterable, Iterator
+import queue
+from contextlib import contextmanager
+import re
+from difflib import SequenceMatcher
+import io
+import base64
+import hashlib
+import functools
+from collections import OrderedDict, deque, namedtuple
+import asyncio
+from typing import Callable
+import copy
+import inspect
+import unicodedata
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import gzip
+import shutil
+import atexit
+import secrets
 
 load_dotenv()
 
-logging.basicConfig(level=logging.DEBUG,
-                    filename='executed_commands.log',
-                    format='\n %(message)s \n',
-                    filemode='w')
+AUDIT_LOG_PATH = "executed_commands.log"
+AUDIT_MAX_BYTES = 10_000_000
+AUDIT_BACKUPS = 5
+AUDIT_PAYLOAD_CHARS = 2000
+AUDIT_LIST_ITEMS = 50
+AUDIT_QUEUE_SIZE = 10_000
+
+READ_ONLY_TOOLS = frozenset({"get_current_date", "fetch_data", "get_overdue_rentals", "get_rentals_between", "search_books", "get_books_by_author", "find_user",
+                             "get_user_rental_summary", "get_author_availability", "get_monthly_rentals", "get_popular_books"})
+DISPLAY_DATE_FORMAT = "%d/%m/%Y"
+STORAGE_DATE_FORMAT = "%Y-%m-%d"
+DATE_COLUMNS = frozenset({"rental_date", "return_date"})
+BULK_LOAD_CHUNK_SIZE = 50_000
+BULK_LOAD_PRAGMAS = {"synchronous": "OFF", "cache_size": -262144, "temp_store": "MEMORY"}
+# NORMAL only risks the last commits on power loss under WAL, never corruption
+WAL_PRAGMAS = {"synchronous": "NORMAL", "cache_size": -32768, "temp_store": "MEMORY", "journal_size_limit": 67108864}
+BUSY_TIMEOUT_SECONDS = 5.0
+WRITE_RETRY_ATTEMPTS = 4
+WRITE_RETRY_BASE_DELAY = 0.1
+WRITE_RETRY_MAX_DELAY = 1.0
+
+FETCH_ROW_LIMIT = 200
+FETCH_MAX_ROW_LIMIT = 1000
+FETCH_BATCH_SIZE = 100
+FETCH_BYTE_BUDGET = 16_000
+KEYSET_COLUMNS = ("rental_id", "book_id", "user_id", "isbn")
+ORDER_BY_PATTERN = re.compile(r"\border\s+by\b", re.IGNORECASE)
+HISTORY_TOKEN_BUDGET = 12_000
+HISTORY_KEEP_TURNS = 4
+HISTORY_TOOL_RESULT_CHARS = 400
+PROMPT_TOOL_DESCRIPTION_CHARS = 160
+PROMPT_PARAMETER_DESCRIPTION_CHARS = 120
+# Offered on every turn when tools are selected, the rental workflow needs them to resolve names and dates
+PROMPT_CORE_TOOLS = ("get_current_date", "find_user", "search_books", "fetch_data")
+PROMPT_TOOL_GROUPS = (
+    (re.compile(r"\b(?:rent(?!_)|lend|borrow|loan|check(?:ing|ed|s)?\s*out)", re.IGNORECASE), ("add_rental", "add_rentals_bulk")),
+    (re.compile(r"\b(?:return|bring(?:s|ing)?\s+back|brought\s+back|check(?:ing|ed|s)?\s*in)", re.IGNORECASE), ("return_book", "return_books_bulk")),
+    (re.compile(r"\b(?:overdue|late|due)\b", re.IGNORECASE), ("get_overdue_rentals",)),
+    (re.compile(r"\b(?:between|since|during|until|month|week|year|today|yesterday|\d{1,2}/\d{1,2}/\d{4})", re.IGNORECASE), ("get_rentals_between", "get_monthly_rentals")),
+    (re.compile(r"\b(?:user|member|renter|rentee|patron|reader|customer|people|person)", re.IGNORECASE), ("add_user", "delete_user", "get_user_rental_summary")),
+    (re.compile(r"\b(?:book|title|isbn|cop(?:y|ies)|stock|catalog)", re.IGNORECASE), ("add_book", "delete_book", "get_popular_books")),
+    (re.compile(r"\b(?:author|writer|written|wrote|by)\b", re.IGNORECASE), ("get_books_by_author", "get_author_availability")),
+    (re.compile(r"\b(?:popular|most|top|busiest|statistic|stats|how\s+many|count|trend)", re.IGNORECASE),
+     ("get_popular_books", "get_user_rental_summary", "get_author_availability", "get_monthly_rentals")),
+    (re.compile(r"\b(?:sql|update|insert|change|correct|fix|edit|rename)", re.IGNORECASE), ("execute_sql", "mass_execute")),
+)
+CACHE_MAX_ENTRIES = 256
+CACHE_TTL_SECONDS = 300.0
+SQL_TOKEN_PATTERN = re.compile(r"'(?:[^']|'')*'|\"[^\"]*\"|`[^`]*`|\[[^\]]*\]|\w+(?:\.\w+)?|\S")
+FROM_CLAUSE_END = frozenset({"where", "group", "order", "limit", "having", "window", "union", "intersect", "except", ";"})
+WRITE_TABLE_PATTERN = re.compile(r"\b(?:into|update(?:\s+or\s+\w+)?|delete\s+from|alter\s+table|drop\s+table(?:\s+if\s+exists)?)\s+[\"`\[]?(\w+)", re.IGNORECASE)
+# Writes to a key table also change what queries against the value tables return (via triggers)
+DEPENDENT_TABLES = {"books": {"books_fts", "author_summary"}, "users": {"users_fts"}, "rentals": {"user_rental_summary", "monthly_rental_summary"}}
+DML_PATTERN = re.compile(r"^\s*(?:insert|update|delete|replace)\b", re.IGNORECASE)
+AUTH_SESSION_SECONDS = 300.0
+AUTH_SESSION_OPERATIONS = 20
+RETRY_ATTEMPTS = 4
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 8.0
+HTTP_LIMITS = httpx.Limits(max_connections=10, max_keepalive_connections=5, keepalive_expiry=120.0)
+HTTP_TIMEOUT = httpx.Timeout(120.0, connect=10.0)
+
+PRIVILEGED_TOOLS = frozenset({"execute_sql", "mass_execute"})
+# Ask for a yes/no at the terminal before acting
+CONFIRMING_TOOLS = frozenset({"delete_user", "delete_book"})
+SERVER_CHAT_WORKERS = 8
+SERVER_SQLITE_WORKERS = 4
+SERVER_QUEUE_SIZE = 64
+SERVER_REQUEST_TIMEOUT = 120.0
+SERVER_SESSION_TTL = 1800.0
+SERVER_MAX_SESSIONS = 1000
+SERVER_MAX_BODY = 1_000_000
+SQL_IN_CHUNK_SIZE = 900
+FAST_PATH_WRITE_ROUTES = frozenset({"return", "rent"})
+FAST_PATH_ROUTES = (
+    ("return", re.compile(r"^\s*(?:please\s+)?return\s+(?:rentals?\s+)?(?P<rental_ids>rent_\w+(?:\s*(?:,|and|&)?\s*rent_\w+)*)\s*[.!]?\s*$", re.IGNORECASE)),
+    ("rent", re.compile(r"^\s*(?:please\s+)?rent\s+(?:book\s+)?(?P<book_id>book_\w+)\s+to\s+(?:user\s+)?(?P<user_id>user_\w+)\s*[.!]?\s*$", re.IGNORECASE)),
+    ("books_by", re.compile(r"^\s*(?:list|show)\s+(?:all\s+|me\s+)?(?:the\s+)?books\s+by\s+(?P<author>[^?!]+?)\s*[.!?]?\s*$", re.IGNORECASE)),
+    ("who_has", re.compile(r"^\s*who\s+has\s+(?:book\s+)?(?P<book_id>book_\w+)\s*\??\s*$", re.IGNORECASE)),
+    ("user_rentals", re.compile(r"^\s*what\s+(?:does|has)\s+(?:user\s+)?(?P<user_id>user_\w+)\s+(?:have|got|rented)(?:\s+rented)?\s*\??\s*$", re.IGNORECASE)),
+)
+SEARCH_FUZZY_CANDIDATES = 200
+SEARCH_FUZZY_MIN_SCORE = 0.5
+USER_MATCH_CANDIDATES = 200
+USER_MATCH_MIN_SCORE = 0.6
+USER_DUPLICATE_MIN_SCORE = 0.9
+STATS_MAX_SAMPLES = 1000
+STATS_PROGRESS_STEPS = 1000
+STATS_PLAN_CACHE = 256
+STATS_RECENT_FULL_SCANS = 20
+# A bare "SCAN <table>" walks every row, index scans read "SCAN t USING INDEX ..." and virtual tables add "VIRTUAL TABLE"
+FULL_SCAN_PATTERN = re.compile(r"^SCAN (?!\()(\S+)$")
+
+BOOKS_FTS_SCHEMA = (
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+           title, author, isbn,
+           content='books', content_rowid='rowid',
+           tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+       )''',
+    '''CREATE TRIGGER IF NOT EXISTS books_fts_ai AFTER INSERT ON books BEGIN
+           INSERT INTO books_fts (rowid, title, author, isbn) VALUES (new.rowid, new.title, new.author, new.isbn);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS books_fts_ad AFTER DELETE ON books BEGIN
+           INSERT INTO books_fts (books_fts, rowid, title, author, isbn) VALUES ('delete', old.rowid, old.title, old.author, old.isbn);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS books_fts_au AFTER UPDATE OF title, author, isbn ON books BEGIN
+           INSERT INTO books_fts (books_fts, rowid, title, author, isbn) VALUES ('delete', old.rowid, old.title, old.author, old.isbn);
+           INSERT INTO books_fts (rowid, title, author, isbn) VALUES (new.rowid, new.title, new.author, new.isbn);
+       END''',
+    "INSERT INTO books_fts (books_fts) VALUES ('rebuild')",
+)
+
+# Unlike books_fts this keeps its own copy of the name with apostrophes removed, so "O'Brien" is indexed as one word "obrien"
+USERS_FTS_SCHEMA = (
+    """CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+           full_name,
+           tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+       )""",
+    """CREATE TRIGGER IF NOT EXISTS users_fts_ai AFTER INSERT ON users BEGIN
+           INSERT INTO users_fts (rowid, full_name) VALUES (new.rowid, replace(replace(new.full_name, '''', ''), '’', ''));
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS users_fts_ad AFTER DELETE ON users BEGIN
+           DELETE FROM users_fts WHERE rowid = old.rowid;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS users_fts_au AFTER UPDATE OF full_name ON users BEGIN
+           UPDATE users_fts SET full_name = replace(replace(new.full_name, '''', ''), '’', '') WHERE rowid = old.rowid;
+       END""",
+    "DELETE FROM users_fts",
+    """INSERT INTO users_fts (rowid, full_name) SELECT rowid, replace(replace(full_name, '''', ''), '’', '') FROM users""",
+)
+
+# Summary tables kept current by triggers, so every write path (tools, execute_sql, bulk loads) updates them
+AUTHOR_SUMMARY_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS author_summary (
+           author TEXT PRIMARY KEY COLLATE NOCASE,
+           titles INTEGER NOT NULL,
+           titles_in_stock INTEGER NOT NULL,
+           copies_in_stock INTEGER NOT NULL,
+           times_rented INTEGER NOT NULL
+       ) WITHOUT ROWID''',
+    "CREATE INDEX IF NOT EXISTS idx_author_summary_rented ON author_summary (times_rented DESC, author)",
+    "CREATE INDEX IF NOT EXISTS idx_books_popularity ON books (amount_of_times_rented DESC, book_id)",
+    '''CREATE TRIGGER IF NOT EXISTS author_summary_ai AFTER INSERT ON books BEGIN
+           INSERT INTO author_summary (author, titles, titles_in_stock, copies_in_stock, times_rented)
+           VALUES (new.author, 1, new.quantity > 0, new.quantity, new.amount_of_times_rented)
+           ON CONFLICT(author) DO UPDATE SET titles = titles + 1, titles_in_stock = titles_in_stock + excluded.titles_in_stock,
+               copies_in_stock = copies_in_stock + excluded.copies_in_stock, times_rented = times_rented + excluded.times_rented;
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS author_summary_ad AFTER DELETE ON books BEGIN
+           UPDATE author_summary SET titles = titles - 1, titles_in_stock = titles_in_stock - (old.quantity > 0),
+               copies_in_stock = copies_in_stock - old.quantity, times_rented = times_rented - old.amount_of_times_rented
+           WHERE author = old.author;
+           DELETE FROM author_summary WHERE author = old.author AND titles <= 0;
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS author_summary_au AFTER UPDATE OF author, quantity, amount_of_times_rented ON books BEGIN
+           UPDATE author_summary SET titles = titles - 1, titles_in_stock = titles_in_stock - (old.quantity > 0),
+               copies_in_stock = copies_in_stock - old.quantity, times_rented = times_rented - old.amount_of_times_rented
+           WHERE author = old.author;
+           DELETE FROM author_summary WHERE author = old.author AND titles <= 0;
+           INSERT INTO author_summary (author, titles, titles_in_stock, copies_in_stock, times_rented)
+           VALUES (new.author, 1, new.quantity > 0, new.quantity, new.amount_of_times_rented)
+           ON CONFLICT(author) DO UPDATE SET titles = titles + 1, titles_in_stock = titles_in_stock + excluded.titles_in_stock,
+               copies_in_stock = copies_in_stock + excluded.copies_in_stock, times_rented = times_rented + excluded.times_rented;
+       END''',
+    "DELETE FROM author_summary",
+    '''INSERT INTO author_summary (author, titles, titles_in_stock, copies_in_stock, times_rented)
+       SELECT author, count(*), sum(quantity > 0), sum(quantity), sum(amount_of_times_rented)
+       FROM books GROUP BY author COLLATE NOCASE''',
+)
+MONTHLY_RENTAL_SUMMARY_REBUILD = (
+    "DELETE FROM monthly_rental_summary",
+    '''INSERT INTO monthly_rental_summary (month, rentals, returns)
+       SELECT month, sum(rentals), sum(returns) FROM (
+           SELECT substr(rental_date, 1, 7) AS month, 1 AS rentals, 0 AS returns FROM rentals
+           UNION ALL
+           SELECT substr(return_date, 1, 7), 0, 1 FROM rentals WHERE return_date IS NOT NULL
+       ) GROUP BY month''',
+)
+RENTAL_SUMMARY_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS user_rental_summary (
+           user_id TEXT PRIMARY KEY,
+           active_rentals INTEGER NOT NULL,
+           total_rentals INTEGER NOT NULL
+       ) WITHOUT ROWID''',
+    "CREATE INDEX IF NOT EXISTS idx_user_rental_summary_active ON user_rental_summary (active_rentals DESC, user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_user_rental_summary_total ON user_rental_summary (total_rentals DESC, user_id)",
+    '''CREATE TABLE IF NOT EXISTS monthly_rental_summary (
+           month TEXT PRIMARY KEY,
+           rentals INTEGER NOT NULL,
+           returns INTEGER NOT NULL
+       ) WITHOUT ROWID''',
+    '''CREATE TRIGGER IF NOT EXISTS rental_summary_ai AFTER INSERT ON rentals BEGIN
+           INSERT INTO user_rental_summary (user_id, active_rentals, total_rentals) VALUES (new.user_id, new.return_date IS NULL, 1)
+           ON CONFLICT(user_id) DO UPDATE SET active_rentals = active_rentals + excluded.active_rentals, total_rentals = total_rentals + 1;
+           INSERT INTO monthly_rental_summary (month, rentals, returns) VALUES (substr(new.rental_date, 1, 7), 1, 0)
+           ON CONFLICT(month) DO UPDATE SET rentals = rentals + 1;
+           INSERT INTO monthly_rental_summary (month, rentals, returns) SELECT substr(new.return_date, 1, 7), 0, 1 WHERE new.return_date IS NOT NULL
+           ON CONFLICT(month) DO UPDATE SET returns = returns + 1;
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS rental_summary_ad AFTER DELETE ON rentals BEGIN
+           UPDATE user_rental_summary SET active_rentals = active_rentals - (old.return_date IS NULL), total_rentals = total_rentals - 1
+           WHERE user_id = old.user_id;
+           DELETE FROM user_rental_summary WHERE user_id = old.user_id AND total_rentals <= 0;
+           UPDATE monthly_rental_summary SET rentals = rentals - 1 WHERE month = substr(old.rental_date, 1, 7);
+           UPDATE monthly_rental_summary SET returns = returns - 1 WHERE month = substr(old.return_date, 1, 7);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS rental_summary_au AFTER UPDATE OF user_id, rental_date, return_date ON rentals BEGIN
+           UPDATE user_rental_summary SET active_rentals = active_rentals - (old.return_date IS NULL), total_rentals = total_rentals - 1
+           WHERE user_id = old.user_id;
+           DELETE FROM user_rental_summary WHERE user_id = old.user_id AND total_rentals <= 0;
+           UPDATE monthly_rental_summary SET rentals = rentals - 1 WHERE month = substr(old.rental_date, 1, 7);
+           UPDATE monthly_rental_summary SET returns = returns - 1 WHERE month = substr(old.return_date, 1, 7);
+           INSERT INTO user_rental_summary (user_id, active_rentals, total_rentals) VALUES (new.user_id, new.return_date IS NULL, 1)
+           ON CONFLICT(user_id) DO UPDATE SET active_rentals = active_rentals + excluded.active_rentals, total_rentals = total_rentals + 1;
+           INSERT INTO monthly_rental_summary (month, rentals, returns) VALUES (substr(new.rental_date, 1, 7), 1, 0)
+           ON CONFLICT(month) DO UPDATE SET rentals = rentals + 1;
+           INSERT INTO monthly_rental_summary (month, rentals, returns) SELECT substr(new.return_date, 1, 7), 0, 1 WHERE new.return_date IS NOT NULL
+           ON CONFLICT(month) DO UPDATE SET returns = returns + 1;
+       END''',
+    "DELETE FROM user_rental_summary",
+    '''INSERT INTO user_rental_summary (user_id, active_rentals, total_rentals)
+       SELECT user_id, sum(return_date IS NULL), count(*) FROM rentals GROUP BY user_id''',
+    *MONTHLY_RENTAL_SUMMARY_REBUILD,
+)
+# Crockford base32 in lower case, to match the existing ID style; its letter order keeps string order equal to time order
+ID_TIME_ALPHABET = "0123456789abcdefghjkmnpqrstvwxyz"
+ID_RANDOM_ALPHABET = string.ascii_lowercase + string.digits
+ID_RANDOM_BITS = 80
+ID_COLLISION_RETRIES = 5
+SUMMARY_DEFAULT_LIMIT = 10
+SUMMARY_MAX_LIMIT = 100
+RENTALS_DEFAULT_LIMIT = 50
+RENTALS_MAX_LIMIT = 200
+
+RENTAL_DATE_NORMALIZATION = (
+    """UPDATE rentals
+       SET rental_date = substr(rental_date, 7, 4) || '-' || substr(rental_date, 4, 2) || '-' || substr(rental_date, 1, 2)
+       WHERE rental_date GLOB '[0-3][0-9]/[0-1][0-9]/[0-9][0-9][0-9][0-9]'""",
+    """UPDATE rentals
+       SET return_date = substr(return_date, 7, 4) || '-' || substr(return_date, 4, 2) || '-' || substr(return_date, 1, 2)
+       WHERE return_date GLOB '[0-3][0-9]/[0-1][0-9]/[0-9][0-9][0-9][0-9]'""",
+)
+# Every write path, raw SQL included, must store YYYY-MM-DD, the summaries and date range queries slice and compare that text
+RENTAL_DATE_CHECKS = (
+    '''CREATE TRIGGER IF NOT EXISTS rentals_iso_dates_bi BEFORE INSERT ON rentals
+       WHEN date(new.rental_date, '+0 days') IS NOT new.rental_date OR (new.return_date IS NOT NULL AND date(new.return_date, '+0 days') IS NOT new.return_date)
+       BEGIN
+           SELECT RAISE(ABORT, 'rental_date and return_date must be stored as YYYY-MM-DD');
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS rentals_iso_dates_bu BEFORE UPDATE OF rental_date, return_date ON rentals
+       WHEN (new.rental_date IS NOT old.rental_date AND date(new.rental_date, '+0 days') IS NOT new.rental_date)
+         OR (new.return_date IS NOT old.return_date AND new.return_date IS NOT NULL AND date(new.return_date, '+0 days') IS NOT new.return_date)
+       BEGIN
+           SELECT RAISE(ABORT, 'rental_date and return_date must be stored as YYYY-MM-DD');
+       END''',
+)
+
+BOOKS_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS idx_books_title ON books (title, book_id)",
+    "CREATE INDEX IF NOT EXISTS idx_books_author ON books (author, title, book_id)",
+)
+
+# (user_version, steps) applied in order by Librarian._run_migrations; a step is SQL or a callable(conn)
+SCHEMA_MIGRATIONS: list[tuple[int, tuple]] = [
+    (1, (
+        "CREATE INDEX IF NOT EXISTS idx_rentals_user ON rentals (user_id, return_date, book_id, rental_date)",
+        "CREATE INDEX IF NOT EXISTS idx_rentals_book ON rentals (book_id, return_date, user_id, rental_date)",
+        "CREATE INDEX IF NOT EXISTS idx_rentals_active ON rentals (book_id, user_id, rental_date) WHERE return_date IS NULL",
+        *BOOKS_INDEXES,
+    )),
+    (2, (
+        *RENTAL_DATE_NORMALIZATION,
+        "CREATE INDEX IF NOT EXISTS idx_rentals_rental_date ON rentals (rental_date)",
+        "CREATE INDEX IF NOT EXISTS idx_rentals_active_since ON rentals (rental_date) WHERE return_date IS NULL",
+    )),
+    (3, BOOKS_FTS_SCHEMA),
+    (4, RENTAL_SUMMARY_SCHEMA + AUTHOR_SUMMARY_SCHEMA),
+    (5, USERS_FTS_SCHEMA),
+    # Raw SQL could still write DD/MM/YYYY dates before the checks existed, which also left bad monthly summary keys
+    (6, RENTAL_DATE_NORMALIZATION + RENTAL_DATE_CHECKS + MONTHLY_RENTAL_SUMMARY_REBUILD),
+]
+
+class AuditFormatter(logging.Formatter):
+    def __init__(self, payload_chars: int = AUDIT_PAYLOAD_CHARS):
+        super().__init__()
+        self.payload_chars: int = payload_chars
+
+    def _truncate(self, value):
+        if isinstance(value, str) and len(value) > self.payload_chars:
+            return f"{value[:self.payload_chars]}... [{len(value) - self.payload_chars} more chars]"
+        if isinstance(value, dict):
+            return {key: self._truncate(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            items = [self._truncate(item) for item in value[:AUDIT_LIST_ITEMS]]
+            return items + [f"... [{len(value) - AUDIT_LIST_ITEMS} more items]"] if len(value) > AUDIT_LIST_ITEMS else items
+        return value
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"), "level": record.levelname,
+                 "logger": record.name, "thread": record.threadName, "message": self._truncate(record.getMessage())}
+        if (data := getattr(record, "audit", None)) is not None:
+            entry["data"] = self._truncate(data)
+        if record.exc_info:
+            entry["exception"] = self._truncate(self.formatException(record.exc_info))
+        return json.dumps(entry, default=str)
+
+class AuditQueueHandler(QueueHandler):
+    def __init__(self, audit_queue: queue.Queue):
+        super().__init__(audit_queue)
+        self.dropped: int = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Records stay in this process, so formatting (and truncating large payloads) is left to the writer thread
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Losing an audit line is better than stalling a tool call behind a slow disk
+            self.dropped += 1
+        return None
+
+class AuditListener(QueueListener):
+    def __init__(self, audit_queue: queue.Queue, *handlers: logging.Handler, respect_handler_level: bool = False):
+        super().__init__(audit_queue, *handlers, respect_handler_level=respect_handler_level)
+        self.running: bool = False
+
+    def start(self) -> None:
+        super().start()
+        self.running = True
+        return None
+
+    def stop(self) -> None:
+        # QueueListener.stop() fails when called a second time, e.g. once by the caller and again at exit
+        if self.running:
+            self.running = False
+            super().stop()
+        return None
+
+def compress_rotated_log(source: str, destination: str) -> None:
+    with open(source, "rb") as plain, gzip.open(destination, "wb") as compressed:
+        shutil.copyfileobj(plain, compressed)
+    os.remove(source)
+    return None
+
+def start_audit_log(path: str = AUDIT_LOG_PATH, max_bytes: int = AUDIT_MAX_BYTES, backups: int = AUDIT_BACKUPS,
+                    payload_chars: int = AUDIT_PAYLOAD_CHARS, level: int = logging.DEBUG) -> AuditListener:
+    # Appends across restarts; rotated files become executed_commands.log.1.gz, .2.gz, ...
+    # Importing main configures no logging, so a script that uses Librarian or Mistral_Ai directly calls this
+    # (or logging.basicConfig) itself, otherwise only warnings reach stderr through logging.lastResort
+    file_handler = RotatingFileHandler(path, mode="a", maxBytes=max_bytes, backupCount=backups, encoding="utf-8", delay=True)
+    file_handler.namer = lambda name: f"{name}.gz"
+    file_handler.rotator = compress_rotated_log
+    file_handler.setFormatter(AuditFormatter(payload_chars))
+
+    audit_queue: queue.Queue = queue.Queue(maxsize=AUDIT_QUEUE_SIZE)
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(AuditQueueHandler(audit_queue))
+    root.setLevel(level)
+
+    listener = AuditListener(audit_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(stop_audit_log, listener)
+    return listener
+
+def stop_audit_log(listener: AuditListener) -> None:
+    # Flushes whatever is still queued, safe to call again at exit
+    listener.stop()
+    return None
+
+class TimeOrderedIdGenerator:
+    # ULID layout: 48 bits of Unix milliseconds then 80 random bits, so new keys land at the right edge of the B-tree
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last_ms: int = -1
+        self._last_random: int = 0
+
+    def _next_value(self) -> int:
+        now_ms = time.time_ns() // 1_000_000
+        if now_ms <= self._last_ms:
+            # Same millisecond, or the clock stepped back: count up from the last ID so order and uniqueness hold
+            self._last_random += 1
+            if self._last_random >> ID_RANDOM_BITS:
+                self._last_ms, self._last_random = self._last_ms + 1, secrets.randbits(ID_RANDOM_BITS - 1)
+        else:
+            self._last_ms, self._last_random = now_ms, secrets.randbits(ID_RANDOM_BITS)
+        return (self._last_ms << ID_RANDOM_BITS) | self._last_random
+
+    @staticmethod
+    def _encode(value: int) -> str:
+        chars = []
+        for _ in range(26):
+            chars.append(ID_TIME_ALPHABET[value & 31])
+            value >>= 5
+        return "".join(reversed(chars))
+
+    def new(self, prefix: str) -> str:
+        with self._lock:
+            value = self._next_value()
+        return f"{prefix}_{self._encode(value)}"
+
+    def batch(self, prefix: str, count: int) -> list[str]:
+        with self._lock:
+            values = [self._next_value() for _ in range(count)]
+        return [f"{prefix}_{self._encode(value)}" for value in values]
+
+class RandomIdGenerator:
+    # The original short random IDs (e.g. book_x7k2m9qa); uniqueness relies on the collision retry at insert time
+    def __init__(self, length: int = 8):
+        self.length: int = length
+
+    def new(self, prefix: str) -> str:
+        return f"{prefix}_{''.join(random.choices(ID_RANDOM_ALPHABET, k=self.length))}"
+
+    def batch(self, prefix: str, count: int) -> list[str]:
+        ids = set()
+        while len(ids) < count:
+            ids.add(self.new(prefix))
+        return list(ids)
+
+def is_id_clash(error: sqlite3.IntegrityError, column: str) -> bool:
+    return f"UNIQUE constraint failed: {column}" in str(error)
+
+def normalize_name(name: str) -> list[str]:
+    # Same folding as users_fts, so "Zoë O'Brien" and "zoe obrien" compare equal word by word
+    decomposed = unicodedata.normalize("NFKD", re.sub(r"['’]", "", str(name or "")))
+    return re.findall(r"\w+", "".join(char for char in decomposed if not unicodedata.combining(char)).casefold())
+
+@functools.lru_cache(maxsize=65536)
+def word_similarity(word: str, other: str) -> float:
+    # Names repeat a lot across candidates and lookups, so most pairs are a cache hit
+    return SequenceMatcher(None, word, other).ratio()
+
+def name_similarity(words: list[str], other: list[str]) -> float:
+    # How well each of `words` is matched by some word of `other`, averaged; not symmetric
+    if not words or not other:
+        return 0.0
+    return sum(max(word_similarity(word, candidate) for candidate in other) for word in words) / len(words)
+
+def to_storage_date(value: str) -> str:
+    for date_format in (DISPLAY_DATE_FORMAT, STORAGE_DATE_FORMAT):
+        try:
+            return datetime.strptime(value.strip(), date_format).strftime(STORAGE_DATE_FORMAT)
+        except ValueError:
+            continue
+    raise ValueError(f"'{value}' is not a valid DD/MM/YYYY date")
+
+@functools.lru_cache(maxsize=4096)
+def to_display_date(value: str | None) -> str | None:
+    # Result sets repeat the same few dates on many rows, and strptime is the slowest step of formatting them
+    try:
+        return datetime.strptime(value, STORAGE_DATE_FORMAT).strftime(DISPLAY_DATE_FORMAT)
+    except (TypeError, ValueError):
+        return value
+
+def column_names(cursor: sqlite3.Cursor) -> tuple[str, ...]:
+    return tuple(column[0] for column in cursor.description)
+
+def fetch_rows(cursor: sqlite3.Cursor) -> tuple[tuple[str, ...], list[tuple]]:
+    # One header for the whole result, the rows stay plain tuples
+    return column_names(cursor), cursor.fetchall()
+
+@functools.lru_cache(maxsize=256)
+def record_type(columns: tuple[str, ...]) -> type:
+    # namedtuples have empty __slots__, so a record costs no more than the tuple and still reads as row.title
+    return namedtuple("Record", columns, rename=True)
+
+def fetch_records(cursor: sqlite3.Cursor) -> list[tuple]:
+    return list(map(record_type(column_names(cursor))._make, cursor.fetchall()))
+
+@functools.lru_cache(maxsize=256)
+def row_template(columns: tuple[str, ...]) -> str:
+    # One %r per column renders a tuple exactly as str() renders the dict {column: value, ...}
+    return "{" + ", ".join(repr(column).replace("%", "%%") + ": %r" for column in columns) + "}"
 
 def check_password(password):
     return bcrypt.checkpw(password.encode('utf-8'), b'$2b$12$eEkHgtcMIVJkbVXVTGWebucHHNGaT12lauuz6rxEwHcWBymqhOVa.')
 
+class AuthorizationSession:
+    def __init__(self, window_seconds: float = AUTH_SESSION_SECONDS, max_operations: int = AUTH_SESSION_OPERATIONS, interactive: bool = True):
+        self.window_seconds: float = window_seconds
+        self.max_operations: int = max_operations
+        self.interactive: bool = interactive
+        self._expires_at: float = 0.0
+        self._operations_left: int = 0
+        self._lock = threading.Lock()
+        self._verifier: ThreadPoolExecutor = None
+
+    def is_active(self) -> bool:
+        return self._operations_left > 0 and time.monotonic() < self._expires_at
+
+    def _verify(self, password: str) -> bool:
+        # bcrypt releases the GIL, so checking on a worker keeps the rest of the process running
+        if self._verifier is None:
+            self._verifier = ThreadPoolExecutor(max_workers=1, thread_name_prefix="librarian-auth")
+        return self._verifier.submit(check_password, password).result()
+
+    def authorize(self, description: str) -> bool:
+        with self._lock:
+            if self.is_active():
+                self._operations_left -= 1
+                print(f"Authorised by the active admin session ({self._operations_left} operations left): {description}")
+                logging.warning(f"AUTHORISED BY SESSION ({self._operations_left} operations left): {description}")
+                return True
+
+            if not self.interactive:
+                # Nobody is at the terminal to type the password (server mode)
+                logging.warning(f"AUTHORISATION DENIED (no interactive terminal): {description}")
+                return False
+            passkey_input = getpass(f"You are about to execute '{description}' This is an irreverasable change!\nEnter your password to confirm: ")
+            if not self._verify(passkey_input):
+                logging.warning(f"AUTHORISATION DENIED: {description}")
+                return False
+            if self.window_seconds > 0 and self.max_operations > 1:
+                self._expires_at = time.monotonic() + self.window_seconds
+                self._operations_left = self.max_operations - 1
+                logging.warning(f"ADMIN SESSION OPENED for {self.window_seconds:.0f}s / {self.max_operations} operations")
+            logging.warning(f"AUTHORISED BY PASSWORD: {description}")
+            return True
+
+    def revoke(self) -> None:
+        with self._lock:
+            was_active = self.is_active()
+            self._expires_at, self._operations_left = 0.0, 0
+        if was_active:
+            logging.warning("ADMIN SESSION REVOKED")
+        return None
+
+def percentile(values: Iterable[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+class Instrumentation:
+    def __init__(self, max_samples: int = STATS_MAX_SAMPLES):
+        self.max_samples: int = max_samples
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._tools: dict[str, dict] = {}
+        self._llm: deque[float] = deque(maxlen=max_samples)
+        self._plans: OrderedDict[str, list[str]] = OrderedDict()
+        self.recent_full_scans: deque[dict] = deque(maxlen=STATS_RECENT_FULL_SCANS)
+        self.llm_calls: int = 0
+        self.llm_seconds: float = 0.0
+        self.sql_seconds: float = 0.0
+        self.prompt_requests: int = 0
+        self.prompt_tokens: dict[str, int] = {}
+        self.last_prompt: dict[str, int] = {}
+
+    @contextmanager
+    def tool(self, name: str) -> Iterator[dict]:
+        record = {"tool": name, "sql_seconds": 0.0, "rows_returned": 0, "vm_steps": 0, "output_bytes": 0, "full_scans": []}
+        outer = getattr(self._local, "record", None)
+        self._local.record = record
+        started = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["wall_seconds"] = time.perf_counter() - started
+            self._local.record = outer
+            self._add(record)
+
+    def _add(self, record: dict) -> None:
+        with self._lock:
+            stats = self._tools.setdefault(record["tool"], {"calls": 0, "wall": deque(maxlen=self.max_samples), "sql": deque(maxlen=self.max_samples),
+                                                            "wall_seconds": 0.0, "sql_seconds": 0.0, "rows_returned": 0, "vm_steps": 0,
+                                                            "output_bytes": 0, "full_scans": 0})
+            stats["calls"] += 1
+            stats["wall"].append(record["wall_seconds"])
+            stats["sql"].append(record["sql_seconds"])
+            for field in ("wall_seconds", "sql_seconds", "rows_returned", "vm_steps", "output_bytes"):
+                stats[field] += record[field]
+            stats["full_scans"] += bool(record["full_scans"])
+            self.sql_seconds += record["sql_seconds"]
+        logging.info("TOOL STATS %s", record["tool"], extra={"audit": record})
+        return None
+
+    def record_sql(self, seconds: float, rows: int = 0) -> None:
+        # Only work done inside a tool call is attributed, bookkeeping queries outside one are ignored
+        if record := getattr(self._local, "record", None):
+            record["sql_seconds"] += seconds
+            record["rows_returned"] += rows
+        return None
+
+    def count_vm_steps(self) -> int:
+        # SQLite calls this every STATS_PROGRESS_STEPS virtual machine instructions, the closest it offers to "rows scanned"
+        if record := getattr(self._local, "record", None):
+            record["vm_steps"] += STATS_PROGRESS_STEPS
+        return 0
+
+    def record_llm(self, seconds: float) -> None:
+        with self._lock:
+            self._llm.append(seconds)
+            self.llm_calls += 1
+            self.llm_seconds += seconds
+        return None
+
+    def record_prompt(self, tokens: dict[str, int]) -> None:
+        with self._lock:
+            self.prompt_requests += 1
+            for section, count in tokens.items():
+                self.prompt_tokens[section] = self.prompt_tokens.get(section, 0) + count
+            self.last_prompt = dict(tokens)
+        logging.info("PROMPT TOKENS %d", tokens.get("total", 0), extra={"audit": tokens})
+        return None
+
+    def capture_plan(self, conn: sqlite3.Connection, sql: str, params: tuple) -> list[str]:
+        key = " ".join(sql.split())
+        with self._lock:
+            plan = self._plans.get(key)
+        if plan is None:
+            outer, self._local.record = getattr(self._local, "record", None), None
+            try:
+                plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+            except sqlite3.Error:
+                plan = []
+            finally:
+                self._local.record = outer
+            with self._lock:
+                self._plans[key] = plan
+                if len(self._plans) > STATS_PLAN_CACHE:
+                    self._plans.popitem(last=False)
+            logging.info("QUERY PLAN", extra={"audit": {"sql": key, "plan": plan}})
+        full_scans = [match.group(1) for line in plan if (match := FULL_SCAN_PATTERN.match(line))]
+        if full_scans:
+            if record := getattr(self._local, "record", None):
+                record["full_scans"] += full_scans
+            self.recent_full_scans.append({"sql": key[:300], "tables": full_scans})
+            logging.warning("FULL SCAN of %s", ", ".join(full_scans), extra={"audit": {"sql": key, "plan": plan}})
+        return full_scans
+
+    def summary(self) -> dict:
+        with self._lock:
+            tools = {name: {"calls": stats["calls"],
+                            "wall_p50_ms": round(1000 * percentile(stats["wall"], 0.5), 2), "wall_p95_ms": round(1000 * percentile(stats["wall"], 0.95), 2),
+                            "sql_p50_ms": round(1000 * percentile(stats["sql"], 0.5), 2), "sql_p95_ms": round(1000 * percentile(stats["sql"], 0.95), 2),
+                            "avg_rows_returned": round(stats["rows_returned"] / stats["calls"], 1),
+                            "avg_vm_steps": round(stats["vm_steps"] / stats["calls"]),
+                            "avg_output_bytes": round(stats["output_bytes"] / stats["calls"]),
+                            "calls_with_full_scan": stats["full_scans"]}
+                     for name, stats in sorted(self._tools.items())}
+            llm = {"calls": self.llm_calls, "p50_ms": round(1000 * percentile(self._llm, 0.5), 2),
+                   "p95_ms": round(1000 * percentile(self._llm, 0.95), 2)}
+            totals = {"tool_seconds": round(sum(stats["wall_seconds"] for stats in self._tools.values()), 3),
+                      "sql_seconds": round(self.sql_seconds, 3), "llm_seconds": round(self.llm_seconds, 3)}
+            prompt = {"requests": self.prompt_requests, "last_request": dict(self.last_prompt),
+                      "avg_tokens": {section: round(count / self.prompt_requests) for section, count in self.prompt_tokens.items()} if self.prompt_requests else {}}
+        return {"tools": tools, "llm": llm, "prompt": prompt, "totals": totals, "recent_full_scans": list(self.recent_full_scans)}
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def _record(self, started: float, rows: int = 0) -> None:
+        self.connection.instrumentation.record_sql(time.perf_counter() - started, rows)
+        return None
+
+    def execute(self, sql: str, parameters=()) -> Self:
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._record(started)
+
+    def executemany(self, sql: str, seq_of_parameters) -> Self:
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._record(started)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._record(started, row is not None)
+        return row
+
+    def fetchmany(self, size: int | None = None) -> list:
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._record(started, len(rows))
+        return rows
+
+    def fetchall(self) -> list:
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._record(started, len(rows))
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        row = super().__next__()
+        self._record(started, 1)
+        return row
+
+class InstrumentedConnection(sqlite3.Connection):
+    instrumentation: Instrumentation = None
+
+    def cursor(self, factory=InstrumentedCursor) -> sqlite3.Cursor:
+        return super().cursor(factory)
+
+    # sqlite3.Connection.execute builds a plain cursor internally, route it through ours
+    def execute(self, sql: str, parameters=()) -> sqlite3.Cursor:
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql: str, seq_of_parameters) -> sqlite3.Cursor:
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+class ReadWriteLock:
+    # Many readers or one writer, with waiting writers served first so a stream of reads cannot starve them
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers: int = 0
+        self._writing: bool = False
+        self._waiting_writers: int = 0
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        with self._condition:
+            while self._writing or self._waiting_writers:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        with self._condition:
+            self._waiting_writers += 1
+            while self._writing or self._readers:
+                self._condition.wait()
+            self._waiting_writers -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+def is_busy_error(error: Exception) -> bool:
+    return isinstance(error, sqlite3.OperationalError) and getattr(error, "sqlite_errorcode", None) in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+
+class ConnectionManager:
+    def __init__(self, database: str = "library.db", readers: int = 4, health_check_interval: float = 30.0,
+                 instrumentation: Instrumentation | None = None, journal_mode: str = "wal", busy_timeout: float = BUSY_TIMEOUT_SECONDS):
+        self.database: str = database
+        self.journal_mode: str = journal_mode.lower()
+        self.busy_timeout: float = busy_timeout
+        self.instrumentation: Instrumentation = instrumentation or Instrumentation()
+        self.readers: int = max(1, readers)
+        self.health_check_interval: float = health_check_interval
+        self._writer: sqlite3.Connection = None
+        self._writer_checked_at: float = 0.0
+        self._writer_lock = threading.RLock()
+        self._idle_readers: queue.LifoQueue[tuple[sqlite3.Connection, float]] = queue.LifoQueue()
+        self._reader_slots = threading.BoundedSemaphore(self.readers)
+        self._closed: bool = False
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+        return None
+
+    def _connect(self, read_only: bool = False) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.database, timeout=self.busy_timeout, check_same_thread=False, factory=InstrumentedConnection)
+        conn.instrumentation = self.instrumentation
+        conn.set_progress_handler(self.instrumentation.count_vm_steps, STATS_PROGRESS_STEPS)
+        conn.execute("PRAGMA foreign_keys = ON;")
+        if not read_only:
+            # The journal mode is stored in the file, so readers and other terminals pick it up from the writer
+            conn.execute(f"PRAGMA journal_mode = {self.journal_mode}")
+        if self.journal_mode == "wal":
+            for name, value in WAL_PRAGMAS.items():
+                conn.execute(f"PRAGMA {name} = {value}")
+        if read_only:
+            conn.execute("PRAGMA query_only = ON;")
+        return conn
+
+    def _is_healthy(self, conn: sqlite3.Connection, checked_at: float) -> bool:
+        try:
+            if time.monotonic() - checked_at < self.health_check_interval:
+                conn.total_changes
+            else:
+                conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def writer(self) -> sqlite3.Connection:
+        with self._writer_lock:
+            if self._closed:
+                raise sqlite3.ProgrammingError("Connection manager has been closed.")
+            if self._writer is None or not self._is_healthy(self._writer, self._writer_checked_at):
+                if self._writer is not None:
+                    logging.warning("Writer connection was unhealthy, reconnecting")
+                self._writer = self._connect()
+                self._writer_checked_at = time.monotonic()
+            elif time.monotonic() - self._writer_checked_at >= self.health_check_interval:
+                self._writer_checked_at = time.monotonic()
+            return self._writer
+
+    def begin_immediate(self) -> sqlite3.Connection:
+        # Taking the write lock up front stops two terminals from both passing a check and then both writing;
+        # busy_timeout already waits for the lock, the retries only cover a holder slower than that
+        conn = self.writer()
+        conn.commit()
+        for attempt in range(WRITE_RETRY_ATTEMPTS):
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                return conn
+            except sqlite3.OperationalError as e:
+                if attempt == WRITE_RETRY_ATTEMPTS - 1 or not is_busy_error(e):
+                    raise
+                delay = min(WRITE_RETRY_MAX_DELAY, WRITE_RETRY_BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1.0)
+                logging.warning(f"Database is busy ({e}), retrying the write in {delay:.2f}s")
+                time.sleep(delay)
+
+    @contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        if self._closed:
+            raise sqlite3.ProgrammingError("Connection manager has been closed.")
+        self._reader_slots.acquire()
+        conn = None
+        try:
+            try:
+                conn, checked_at = self._idle_readers.get_nowait()
+            except queue.Empty:
+                conn, checked_at = None, 0.0
+            if conn is None or not self._is_healthy(conn, checked_at):
+                if conn is not None:
+                    logging.warning("Reader connection was unhealthy, reconnecting")
+                    conn.close()
+                conn, checked_at = self._connect(read_only=True), time.monotonic()
+            yield conn
+        finally:
+            if conn is not None:
+                if self._closed:
+                    conn.close()
+                else:
+                    if conn.in_transaction:
+                        conn.rollback()
+                    self._idle_readers.put((conn, checked_at))
+            self._reader_slots.release()
+
+    def close(self) -> None:
+        self._closed = True
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.commit()
+                self._writer.execute("PRAGMA optimize;")
+                self._writer.close()
+                self._writer = None
+        while True:
+            try:
+                conn, _ = self._idle_readers.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+        return None
+
+def estimate_tokens(text: str | None) -> int:
+    # Roughly four characters per token for English text and SQL
+    return len(text) // 4 + 1 if text else 0
+
+class QueryCache:
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL_SECONDS):
+        self.max_entries: int = max_entries
+        self.ttl: float = ttl
+        self._entries: OrderedDict[tuple, tuple[float, frozenset[str], str]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.generation: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.invalidations: int = 0
+
+    @staticmethod
+    def make_key(prompt: str, params: tuple, *options) -> tuple:
+        return (" ".join(prompt.strip().rstrip(";").split()), json.dumps(list(params), default=str), *options)
+
+    @staticmethod
+    def tables_read(sql: str) -> frozenset[str]:
+        # Every table of every FROM clause, including comma lists and joins; subqueries are scanned as their own clauses.
+        # An empty set means "unknown", which every write invalidates, so anything unexpected returns one
+        tokens = SQL_TOKEN_PATTERN.findall(sql)
+        tables: set[str] = set()
+        for index, token in enumerate(tokens):
+            if token.lower() != "from":
+                continue
+            depth, expect_table = 0, True
+            for token in tokens[index + 1:]:
+                lowered = token.lower()
+                if token == "(":
+                    depth, expect_table = depth + 1, False
+                elif token == ")":
+                    if not depth:
+                        break
+                    depth -= 1
+                elif depth:
+                    continue
+                elif lowered in FROM_CLAUSE_END:
+                    break
+                elif token == "," or lowered == "join":
+                    expect_table = True
+                elif expect_table:
+                    if not (token[0].isalnum() or token[0] in "_\"`["):
+                        return frozenset()
+                    tables.add(token.strip("\"`[]").rsplit(".", 1)[-1].lower())
+                    expect_table = False
+        return frozenset(tables)
+
+    @staticmethod
+    def tables_written(sql: str) -> frozenset[str] | None:
+        tables = frozenset(table.lower() for table in WRITE_TABLE_PATTERN.findall(sql))
+        return tables or None
+
+    def get(self, key: tuple) -> str | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                if entry is not None:
+                    del self._entries[key]
+                    self.evictions += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key: tuple, tables: frozenset[str], value: str, generation: int) -> None:
+        with self._lock:
+            # A write landed while this result was being computed, so it may already be stale
+            if generation != self.generation:
+                return None
+            self._entries[key] = (time.monotonic(), tables, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return None
+
+    def invalidate(self, tables: Iterable[str] | None = None) -> None:
+        with self._lock:
+            self.generation += 1
+            if tables is None:
+                self.invalidations += len(self._entries)
+                self._entries.clear()
+                return None
+            affected = {table.lower() for table in tables}
+            for table in list(affected):
+                affected |= DEPENDENT_TABLES.get(table, set())
+            stale = [key for key, (_, read, _) in self._entries.items() if not read or read & affected]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+        return None
+
+    def stats(self) -> dict[str, int | float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                    "evictions": self.evictions, "invalidations": self.invalidations}
+
+def invalidates_cache(*tables: str):
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self._cache.invalidate(tables)
+        return wrapper
+    return decorator
+
+class HistoryManager:
+    def __init__(self, token_budget: int = HISTORY_TOKEN_BUDGET, keep_turns: int = HISTORY_KEEP_TURNS,
+                 tool_result_chars: int = HISTORY_TOOL_RESULT_CHARS, archive_path: str | None = None):
+        self.token_budget: int = token_budget
+        self.keep_turns: int = keep_turns
+        self.tool_result_chars: int = tool_result_chars
+        self.archive_path: str | None = archive_path
+        self._summary: SystemMessage = None
+        self._summary_lines: list[str] = []
+
+    @staticmethod
+    def _message_tokens(message) -> int:
+        tokens = estimate_tokens(message.content if isinstance(message.content, str) else str(message.content or ""))
+        for tool_call in getattr(message, "tool_calls", None) or []:
+            tokens += estimate_tokens(tool_call.function.name) + estimate_tokens(str(tool_call.function.arguments))
+        return tokens
+
+    def token_count(self, messages: list) -> int:
+        return sum(self._message_tokens(message) for message in messages)
+
+    def _archive(self, messages: list, reason: str) -> None:
+        if not self.archive_path or not messages:
+            return None
+        with open(self.archive_path, "a", encoding="utf-8") as archive:
+            for message in messages:
+                archive.write(json.dumps({"reason": reason, "message": message.model_dump(mode="json")}, default=str) + "\n")
+        return None
+
+    def _summarise_turn(self, turn: list) -> str:
+        question = next((m.content for m in turn if isinstance(m, UserMessage)), "")
+        answer = next((m.content for m in reversed(turn) if isinstance(m, AssistantMessage) and m.content), "")
+        tools = sorted({tc.function.name for m in turn for tc in (getattr(m, "tool_calls", None) or [])})
+        line = f"- Librarian: {str(question)[:120]}"
+        if tools:
+            line += f" | tools used: {', '.join(tools)}"
+        return line + f" | you answered: {str(answer)[:160]}"
+
+    def _summary_message(self) -> SystemMessage:
+        return SystemMessage(content="Summary of earlier conversation (older turns were removed to save space):\n" + "\n".join(self._summary_lines[-20:]))
+
+    def _compacted_tokens(self, messages: list, head: int, dropped: int) -> int:
+        # Once a turn is dropped the summary is (re)written, so its new size counts against the budget too
+        tokens = self.token_count(messages)
+        if dropped:
+            tokens += self._message_tokens(self._summary_message()) - (self._message_tokens(messages[1]) if head == 2 else 0)
+        return tokens
+
+    def compact(self, messages: list) -> list:
+        if self.token_count(messages) <= self.token_budget:
+            return messages
+        head = 2 if self._summary is not None and len(messages) > 1 and messages[1] is self._summary else 1
+        turn_starts = [index for index in range(head, len(messages)) if isinstance(messages[index], UserMessage)]
+        protected_from = turn_starts[-self.keep_turns] if len(turn_starts) >= self.keep_turns else head
+
+        for index in range(head, protected_from):
+            message = messages[index]
+            if isinstance(message, ToolMessage) and len(str(message.content)) > self.tool_result_chars:
+                content = str(message.content)
+                self._archive([message], "truncated")
+                messages[index] = ToolMessage(name=message.name, tool_call_id=message.tool_call_id,
+                                              content=f"{content[:self.tool_result_chars]}... [truncated {len(content) - self.tool_result_chars} chars]")
+
+        old_turns = [start for start in turn_starts if start < protected_from]
+        dropped = 0
+        while old_turns and self._compacted_tokens(messages, head, dropped) > self.token_budget:
+            start = old_turns.pop(0) - dropped
+            end = (old_turns[0] - dropped) if old_turns else protected_from - dropped
+            turn = messages[start:end]
+            self._archive(turn, "dropped")
+            self._summary_lines.append(self._summarise_turn(turn))
+            del messages[start:end]
+            dropped += end - start
+
+        if dropped:
+            self._summary_lines = self._summary_lines[-20:]
+            summary = self._summary_message()
+            if head == 2:
+                messages[1] = summary
+            else:
+                messages.insert(1, summary)
+            self._summary = summary
+            logging.warning(f"Compacted conversation history to ~{self.token_count(messages)} tokens")
+        return messages
+
+def shorten_description(text: str, limit: int) -> str:
+    # Whole sentences up to the limit, but always the first one, so format rules like DD/MM/YYYY survive
+    sentences = re.split(r"(?<!e\.g\.)(?<!i\.e\.)(?<=[.!?])\s+", " ".join(str(text).split()))
+    kept = sentences[0]
+    for sentence in sentences[1:]:
+        if len(kept) + 1 + len(sentence) > limit:
+            break
+        kept += " " + sentence
+    return kept
+
+def compact_schema(schema: dict, nested: bool = False) -> dict:
+    compact = {key: value for key, value in schema.items() if key not in ("description", "properties", "items")}
+    if "description" in schema and not nested:
+        compact["description"] = shorten_description(schema["description"], PROMPT_PARAMETER_DESCRIPTION_CHARS)
+    if "properties" in schema:
+        compact["properties"] = {name: compact_schema(prop, nested) for name, prop in schema["properties"].items()}
+    if isinstance(items := schema.get("items"), dict):
+        compact["items"] = compact_schema(items, nested=True)
+    elif isinstance(items, list):
+        compact["items"] = [compact_schema(item, nested=True) for item in items]
+    return compact
+
+def compact_tool(tool: dict) -> dict:
+    function = tool["function"]
+    compact = {"name": function["name"], "description": shorten_description(function.get("description", ""), PROMPT_TOOL_DESCRIPTION_CHARS)}
+    if parameters := function.get("parameters"):
+        compact["parameters"] = {"type": "object", **compact_schema(parameters)}
+    return {"type": "function", "function": compact}
+
+def compact_prompt(text: str) -> str:
+    # Indentation and blank lines only help a human reader
+    return "\n".join(" ".join(line.split()) for line in text.splitlines() if line.strip())
+
+class PromptBuilder:
+    def __init__(self, compact: bool = True, select_tools: bool = False):
+        self.compact: bool = compact
+        self.select_tools: bool = select_tools
+        self._compact_tools: dict[str, dict] = {}
+
+    def system_prompt(self, text: str) -> str:
+        return compact_prompt(text) if self.compact else text
+
+    def tools(self, desc_of_tools: list[dict] | None, user_prompt: str = "") -> list[dict]:
+        tools = desc_of_tools or []
+        if self.select_tools and tools:
+            wanted = set(PROMPT_CORE_TOOLS)
+            matched = [names for pattern, names in PROMPT_TOOL_GROUPS if pattern.search(user_prompt or "")]
+            # Nothing recognised (e.g. "yes, go ahead"), the model may need anything
+            if matched:
+                wanted.update(name for names in matched for name in names)
+                tools = [tool for tool in tools if tool["function"]["name"] in wanted]
+        if not self.compact:
+            return tools
+        compact = []
+        for tool in tools:
+            name = tool["function"]["name"]
+            if name not in self._compact_tools:
+                self._compact_tools[name] = compact_tool(tool)
+            compact.append(self._compact_tools[name])
+        return compact
+
+    @staticmethod
+    def account(messages: list, tools: list[dict]) -> dict[str, int]:
+        tokens = {"system": 0, "tools": estimate_tokens(json.dumps(tools, separators=(",", ":"))) if tools else 0, "history": 0, "tool_results": 0}
+        for message in messages:
+            section = "system" if isinstance(message, SystemMessage) else "tool_results" if isinstance(message, ToolMessage) else "history"
+            tokens[section] += HistoryManager._message_tokens(message)
+        tokens["total"] = sum(tokens.values())
+        return tokens
+
+def is_retryable_error(error: BaseException) -> bool:
+    if isinstance(error, httpx.TransportError):
+        return True
+    return isinstance(error, SDKError) and (error.status_code == 429 or error.status_code >= 500)
+
+def retry_delay(attempt: int) -> float:
+    return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+async def ainput(prompt: str) -> str:
+    # A daemon thread, unlike asyncio.to_thread, does not keep the process alive after Ctrl+C
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def settle(setter, value) -> None:
+        if not future.done():
+            setter(value)
+
+    def read() -> None:
+        try:
+            line = input(prompt)
+        except BaseException as e:
+            loop.call_soon_threadsafe(settle, future.set_exception, e)
+        else:
+            loop.call_soon_threadsafe(settle, future.set_result, line)
+
+    threading.Thread(target=read, daemon=True).start()
+    return await future
+
+class IntentRouter:
+    def __init__(self, librarian: "Librarian"):
+        self._librarian: Librarian = librarian
+        self.hits: dict[str, int] = {name: 0 for name, _ in FAST_PATH_ROUTES}
+        self.misses: int = 0
+        self.fast_path_seconds: float = 0.0
+        self.llm_turns: int = 0
+        self.llm_seconds: float = 0.0
+
+    def route(self, command: str) -> str | None:
+        for name, pattern in FAST_PATH_ROUTES:
+            if match := pattern.match(command or ""):
+                started = time.perf_counter()
+                with self._librarian.access(write=name in FAST_PATH_WRITE_ROUTES), self._librarian.instrumentation.tool(f"fast_path.{name}") as stats:
+                    result = getattr(self, f"_route_{name}")(**match.groupdict()).strip()
+                    stats["output_bytes"] = len(result.encode("utf-8"))
+                self.fast_path_seconds += time.perf_counter() - started
+                self.hits[name] += 1
+                logging.warning(f"FAST PATH {name}: {command!r}")
+                return result
+        self.misses += 1
+        return None
+
+    def _route_return(self, rental_ids: str) -> str:
+        rental_ids = re.findall(r"rent_\w+", rental_ids)
+        if len(rental_ids) == 1:
+            return self._librarian.return_book(rental_ids[0], self._librarian.get_current_date())
+        return self._librarian.return_books_bulk(rental_ids, self._librarian.get_current_date())
+
+    def _route_rent(self, book_id: str, user_id: str) -> str:
+        return self._librarian.add_rental(user_id, book_id, self._librarian.get_current_date())
+
+    def _route_books_by(self, author: str) -> str:
+        return self._librarian.get_books_by_author(author)
+
+    def _route_who_has(self, book_id: str) -> str:
+        return self._librarian._fetch_rentals("r.book_id = ? AND r.return_date IS NULL", (book_id,))
+
+    def _route_user_rentals(self, user_id: str) -> str:
+        return self._librarian._fetch_rentals("r.user_id = ? AND r.return_date IS NULL", (user_id,))
+
+    def record_llm_turn(self, seconds: float) -> None:
+        self.llm_turns += 1
+        self.llm_seconds += seconds
+        return None
+
+    def metrics(self) -> dict[str, int | float]:
+        hits = sum(self.hits.values())
+        average_llm_turn = self.llm_seconds / self.llm_turns if self.llm_turns else 0.0
+        return {"fast_path_hits": hits, "fast_path_misses": self.misses, "hit_rate": round(hits / (hits + self.misses), 3) if hits + self.misses else 0.0,
+                "hits_by_route": dict(self.hits), "avg_fast_path_ms": round(1000 * self.fast_path_seconds / hits, 2) if hits else 0.0,
+                "avg_llm_turn_ms": round(1000 * average_llm_turn, 2),
+                "estimated_seconds_saved": round(hits * average_llm_turn - self.fast_path_seconds, 2)}
+
+JSON_SCHEMA_TYPES = {"string": str, "integer": int, "number": (int, float), "boolean": bool, "array": list, "object": dict}
+
+def coerce_argument(value, schema: dict, path: str):
+    # Models often quote numbers or send a list as a JSON string; fix what is unambiguous, reject the rest
+    expected = schema.get("type")
+    if expected in ("integer", "number") and isinstance(value, str):
+        try:
+            value = float(value.strip()) if expected == "number" else int(value.strip())
+        except ValueError:
+            pass
+    elif expected == "integer" and isinstance(value, float) and value.is_integer():
+        value = int(value)
+    elif expected == "boolean" and isinstance(value, str) and value.strip().lower() in ("true", "false"):
+        value = value.strip().lower() == "true"
+    elif expected == "string" and isinstance(value, (int, float)) and not isinstance(value, bool):
+        value = str(value)
+    elif expected in ("array", "object") and isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except json.JSONDecodeError:
+            pass
+
+    if expected in JSON_SCHEMA_TYPES and (not isinstance(value, JSON_SCHEMA_TYPES[expected]) or (expected != "boolean" and isinstance(value, bool))):
+        raise ValueError(f"'{path}' must be of type {expected}, got {json.dumps(value)[:80]}")
+    if "enum" in schema and value not in schema["enum"]:
+        raise ValueError(f"'{path}' must be one of {schema['enum']}, got {json.dumps(value)[:80]}")
+    if isinstance(value, list) and isinstance(items := schema.get("items"), dict):
+        value = [coerce_argument(item, items, f"{path}[{index}]") for index, item in enumerate(value)]
+    elif isinstance(value, list) and isinstance(items, list):
+        if len(value) != len(items):
+            raise ValueError(f"'{path}' must have exactly {len(items)} items, got {len(value)}")
+        value = [coerce_argument(item, item_schema, f"{path}[{index}]") for index, (item, item_schema) in enumerate(zip(value, items))]
+    elif isinstance(value, dict) and "properties" in schema:
+        missing = [key for key in schema.get("required", []) if value.get(key) is None]
+        if missing:
+            raise ValueError(f"'{path}' is missing {', '.join(missing)}")
+        properties = schema["properties"]
+        value = {key: coerce_argument(item, properties[key], f"{path}.{key}") if key in properties else item for key, item in value.items()}
+    return value
+
+class ToolRegistry:
+    # Built once: each allowed tool maps to its bound Librarian method, schema and signature, so a call is a dict lookup
+    def __init__(self, librarian: "Librarian", desc_of_tools: list[dict] | None, allowed: Iterable[str]):
+        schemas = {tool["function"]["name"]: tool["function"].get("parameters") or {} for tool in desc_of_tools or []}
+        self._tools: dict[str, tuple[Callable, dict | None, inspect.Signature]] = {}
+        for name in allowed:
+            method = getattr(librarian, name, None)
+            if name.startswith("_") or not callable(method):
+                raise ValueError(f"'{name}' is not a public Librarian method and cannot be offered as a tool")
+            signature = inspect.signature(method)
+            schema = schemas.get(name)
+            unknown = set((schema or {}).get("properties", {})) - set(signature.parameters)
+            if unknown:
+                raise ValueError(f"The schema for '{name}' describes parameters the method does not take: {', '.join(sorted(unknown))}")
+            self._tools[name] = (method, schema, signature)
+
+    @property
+    def names(self) -> list[str]:
+        return list(self._tools)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._tools
+
+    def prepare(self, name: str, arguments: str | dict | None) -> tuple[Callable | None, dict, list[str]]:
+        # Returns the method, the cleaned arguments and a list of problems; the call is only safe when that list is empty
+        if name not in self._tools:
+            return None, {}, [f"Unknown tool '{name}'."]
+        method, schema, signature = self._tools[name]
+        if isinstance(arguments, str):
+            try:
+                arguments = json.loads(arguments or "{}")
+            except json.JSONDecodeError as e:
+                return method, {}, [f"The arguments are not valid JSON: {e}"]
+        arguments = arguments or {}
+        if not isinstance(arguments, dict):
+            return method, {}, ["The arguments must be a JSON object."]
+
+        problems: list[str] = []
+        properties = (schema or {}).get("properties", {})
+        cleaned = {}
+        for key, value in arguments.items():
+            # An explicit null for an optional argument means "use the default"
+            if value is None and key not in (schema or {}).get("required", []):
+                continue
+            if key not in signature.parameters:
+                problems.append(f"Unexpected argument '{key}'.")
+                continue
+            try:
+                cleaned[key] = coerce_argument(value, properties[key], key) if key in properties else value
+            except ValueError as e:
+                problems.append(f"{e}.")
+        missing = [key for key in (schema or {}).get("required", []) if key not in cleaned and key not in arguments]
+        missing += [key for key, parameter in signature.parameters.items()
+                    if parameter.default is inspect.Parameter.empty and parameter.kind is not parameter.VAR_KEYWORD and key not in arguments and key not in missing]
+        problems += [f"Missing required argument '{key}'." for key in missing]
+        return method, cleaned, problems
+
+    def error_message(self, name: str, problems: list[str]) -> str:
+        # Sent back as the tool result so the model can correct the call in the same turn
+        payload = {"error": "invalid_tool_call", "tool": name, "problems": problems}
+        if name not in self._tools:
+            payload["available_tools"] = self.names
+        elif schema := self._tools[name][1]:
+            payload["parameters"] = {key: prop.get("type", "any") for key, prop in schema.get("properties", {}).items()}
+            payload["required"] = schema.get("required", [])
+        return json.dumps(payload)
+
 class Mistral_Ai:
-    def __init__(self, api: str, model: str,  system_prompt: str, desc_of_tools: dict[str, str | dict], tools: dict[str, partial]):
+    def __init__(self, api: str, model: str,  system_prompt: str, desc_of_tools: list[dict], tools: list[str], max_parallel_reads: int = 4, history: HistoryManager | None = None, librarian: "Librarian | None" = None, fast_path: bool = False,
+                 compact_prompt: bool = True, select_tools: bool = False):
         self.api: str = api
         self.model: str = model
         self._client: Mistral = None
-        self._librarian_ins: Librarian = Librarian()
-        self._messages_sent: list[UserMessage | SystemMessage | AssistantMessage] = [SystemMessage(content=system_prompt)]
+        self._http_client: httpx.Client = None
+        self._async_http_client: httpx.AsyncClient = None
+        self._librarian_ins: Librarian = librarian or Librarian(ConnectionManager(readers=max_parallel_reads))
+        self._prompt: PromptBuilder = PromptBuilder(compact_prompt, select_tools)
+        self._messages_sent: list[UserMessage | SystemMessage | AssistantMessage] = [SystemMessage(content=self._prompt.system_prompt(system_prompt))]
         self.desc_of_tools: dict[str, str | dict] = desc_of_tools
-        self.tools: dict[str, partial] = tools
+        self.tools: list[str] = list(tools)
+        self._registry: ToolRegistry = ToolRegistry(self._librarian_ins, desc_of_tools, self.tools)
+        self.max_parallel_reads: int = max_parallel_reads
+        self._reader_pool: ThreadPoolExecutor = None
+        self._history: HistoryManager = history or HistoryManager()
+        self._router: IntentRouter = IntentRouter(self._librarian_ins) if fast_path else None
 
     def __enter__(self) -> Self:
         self._initilise_clients()
+        self._librarian_ins.__enter__()
         return self
     
     def __exit__(self, exc_type, exc_value, traceback):
         self._client = None
+        if self._http_client:
+            self._http_client.close()
+            self._http_client = None
+        if self._reader_pool:
+            self._reader_pool.shutdown(wait=True)
+            self._reader_pool = None
+        self._librarian_ins.__exit__(exc_type, exc_value, traceback)
         return None
 
+    def fork(self) -> "Mistral_Ai":
+        # A new conversation that shares the pooled clients, the librarian and the reader pool
+        session = copy.copy(self)
+        session._messages_sent = self._messages_sent[:1]
+        session._history = HistoryManager(self._history.token_budget, self._history.keep_turns,
+                                          self._history.tool_result_chars, self._history.archive_path)
+        return session
+
     def _initilise_clients(self):
         if not self._client:
-            self._client = Mistral(api_key=self.api)
+            # Long-lived pooled clients keep the TLS connection to the API warm between turns
+            self._http_client = httpx.Client(limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+            self._async_http_client = httpx.AsyncClient(limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+            self._client = Mistral(api_key=self.api, client=self._http_client, async_client=self._async_http_client)
+        if not self._reader_pool and self.max_parallel_reads > 1:
+            self._reader_pool = ThreadPoolExecutor(max_workers=self.max_parallel_reads,
+                                                   thread_name_prefix="librarian-reader")
         return None
 
+    def _run_tool_call(self, tool_call) -> str:
+        func_name = tool_call.function.name
+        callable_func, func_params, problems = self._registry.prepare(func_name, tool_call.function.arguments)
+        if problems:
+            logging.warning("Rejected tool call: %s", func_name, extra={"audit": {"tool": func_name, "arguments": tool_call.function.arguments, "problems": problems}})
+            return self._registry.error_message(func_name, problems)
+        return self._invoke_tool(func_name, callable_func, func_params)
+
+    def _invoke_tool(self, func_name: str, callable_func: Callable, func_params: dict) -> str:
+        with self._librarian_ins.access(write=func_name not in READ_ONLY_TOOLS), self._librarian_ins.instrumentation.tool(func_name) as stats:
+            try:
+                func_results = str(callable_func(**func_params))
+            except Exception as e:
+                # Returned as the tool result, so the model can correct the call instead of the whole turn failing
+                logging.exception("Tool failed: %s", func_name, extra={"audit": {"tool": func_name, "arguments": func_params, "error": repr(e)}})
+                return f"Error: {func_name} failed: {e}"
+            stats["output_bytes"] = len(func_results.encode("utf-8"))
+        logging.warning("Executed: %s", func_name, extra={"audit": {"tool": func_name, "arguments": func_params, "result": func_results}})
+        return func_results
+
+    def _run_read_batch(self, batch: list[tuple[int, object]], results: list[str]) -> None:
+        # Uncommitted writes are only visible on the writer's connection, so fall back to it
+        if len(batch) == 1 or not self._reader_pool or self._librarian_ins.conn.in_transaction:
+            for index, tool_call in batch:
+                results[index] = self._run_tool_call(tool_call)
+            return None
+        futures = [(index, self._reader_pool.submit(self._run_tool_call, tool_call)) for index, tool_call in batch]
+        for index, future in futures:
+            results[index] = future.result()
+        return None
+
+    def _dispatch_tool_calls(self, tool_calls: list) -> list[str]:
+        results: list[str] = [None] * len(tool_calls)
+        read_batch: list[tuple[int, object]] = []
+        for index, tool_call in enumerate(tool_calls):
+            logging.warning(f"Recieved a function call!")
+            if tool_call.function.name in READ_ONLY_TOOLS:
+                read_batch.append((index, tool_call))
+                continue
+            self._run_read_batch(read_batch, results)
+            read_batch = []
+            results[index] = self._run_tool_call(tool_call)
+        self._run_read_batch(read_batch, results)
+        return results
+
+    async def aclose(self) -> None:
+        if self._async_http_client:
+            await self._async_http_client.aclose()
+            self._async_http_client = None
+        return None
+
+    def _request_tools(self) -> list[dict]:
+        # Chosen from the turn's user message, so every request of one turn offers the same tools
+        user_prompt = next((message.content for message in reversed(self._messages_sent) if isinstance(message, UserMessage)), "")
+        tools = self._prompt.tools(self.desc_of_tools, str(user_prompt or ""))
+        self._librarian_ins.instrumentation.record_prompt(self._prompt.account(self._messages_sent, tools))
+        return tools
+
+    def _complete_with_retry(self):
+        tools = self._request_tools()
+        for attempt in range(RETRY_ATTEMPTS):
+            started = time.perf_counter()
+            try:
+                return self._client.chat.complete(
+                    model = self.model,
+                    messages = self._messages_sent,
+                    tools = tools if tools else {},
+                    tool_choice = "auto",
+                    parallel_tool_calls = True
+                )
+            except Exception as e:
+                if attempt == RETRY_ATTEMPTS - 1 or not is_retryable_error(e):
+                    raise
+                delay = retry_delay(attempt)
+                logging.warning(f"Mistral request failed ({e!r}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+            finally:
+                self._librarian_ins.instrumentation.record_llm(time.perf_counter() - started)
+
+    def _try_fast_path(self, user_prompt: str) -> str | None:
+        if not self._router or (routed := self._router.route(user_prompt)) is None:
+            return None
+        self._messages_sent.append(UserMessage(content=user_prompt))
+        self._messages_sent.append(AssistantMessage(content=routed))
+        return routed
+
     def text_gen(self, user_prompt: str) -> str | None:
  
+        if (routed := self._try_fast_path(user_prompt)) is not None: return routed
         if user_prompt: self._messages_sent.append(UserMessage(content=user_prompt))
         else: print("Invalid Prompt"); return None
         
+        started = time.perf_counter()
+        try:
+            while True:
+                self._history.compact(self._messages_sent)
+                response = self._complete_with_retry()
+                
+                if not response: return None
+
+                response = response.choices[0].message
+                tool_calls = response.tool_calls
+                if tool_calls:
+                    func_results = self._dispatch_tool_calls(tool_calls)
+                    for tool_call, result in zip(tool_calls, func_results):
+                        self._messages_sent.append(AssistantMessage(tool_calls=[tool_call]))
+                        self._messages_sent.append(ToolMessage(name=tool_call.function.name, content=result, tool_call_id=tool_call.id))
+                    continue
+
+                text_response = response.content
+                self._messages_sent.append(AssistantMessage(content=text_response))
+                return text_response
+        finally:
+            if self._router:
+                self._router.record_llm_turn(time.perf_counter() - started)
+
+    def _schedule_tool_call(self, tool_call: ToolCall, scheduled: list[asyncio.Task]) -> asyncio.Task:
+        # Reads only wait for the last write before them, writes wait for everything scheduled so far
+        logging.warning(f"Recieved a function call!")
+        is_read = tool_call.function.name in READ_ONLY_TOOLS
+        if is_read:
+            barrier = next((task for task in reversed(scheduled) if not task.is_read), None)
+            dependencies = [barrier] if barrier else []
+        else:
+            dependencies = list(scheduled)
+
+        async def run() -> str:
+            if dependencies:
+                await asyncio.gather(*dependencies, return_exceptions=True)
+            return await asyncio.to_thread(self._run_tool_call, tool_call)
+
+        task = asyncio.create_task(run())
+        task.is_read = is_read
+        return task
+
+    async def _stream_turn(self, on_token: Callable[[str], None], tool_calls: list[ToolCall], scheduled: list[asyncio.Task]) -> str:
+        # Calls started mid-stream are added to the caller's lists, so they are still known if the stream fails afterwards
+        text_parts: list[str] = []
+        partial_calls: dict[int, dict] = {}
+
+        def dispatch_ready(stream_ended: bool) -> None:
+            # A call is ready once its argument text is non-empty complete JSON; a call with no arguments waits for the stream to end
+            for index, call in sorted(partial_calls.items()):
+                if call["dispatched"] or not call["name"]:
+                    continue
+                if not stream_ended:
+                    if not call["arguments"].strip():
+                        continue
+                    try:
+                        json.loads(call["arguments"])
+                    except json.JSONDecodeError:
+                        continue
+                call["dispatched"] = True
+                tool_call = ToolCall(id=call["id"], index=index,
+                                     function=FunctionCall(name=call["name"], arguments=call["arguments"] or "{}"))
+                tool_calls.append(tool_call)
+                scheduled.append(self._schedule_tool_call(tool_call, scheduled))
+            return None
+
+        tools = self._request_tools()
+        stream = await self._client.chat.stream_async(
+            model = self.model,
+            messages = self._messages_sent,
+            tools = tools if tools else None,
+            tool_choice = "auto",
+            parallel_tool_calls = True
+        )
+        async with stream as events:
+            async for event in events:
+                if not event.data.choices:
+                    continue
+                delta = event.data.choices[0].delta
+                if isinstance(delta.content, str) and delta.content:
+                    text_parts.append(delta.content)
+                    on_token(delta.content)
+                for fragment in delta.tool_calls or []:
+                    call = partial_calls.setdefault(fragment.index or 0, {"id": None, "name": "", "arguments": "", "dispatched": False})
+                    if fragment.id and fragment.id != "null":
+                        call["id"] = fragment.id
+                    call["name"] += fragment.function.name or ""
+                    arguments = fragment.function.arguments
+                    call["arguments"] += arguments if isinstance(arguments, str) else json.dumps(arguments)
+                dispatch_ready(stream_ended=False)
+        # Whatever is left is sent as it stands, the registry rejects arguments that never became valid JSON
+        dispatch_ready(stream_ended=True)
+        return "".join(text_parts)
+
+    async def _record_tool_results(self, tool_calls: list[ToolCall], scheduled: list[asyncio.Task]) -> None:
+        func_results = await asyncio.gather(*scheduled, return_exceptions=True)
+        for tool_call, result in zip(tool_calls, func_results):
+            if isinstance(result, BaseException):
+                result = f"Error: {tool_call.function.name} failed: {result!r}"
+            self._messages_sent.append(AssistantMessage(tool_calls=[tool_call]))
+            self._messages_sent.append(ToolMessage(name=tool_call.function.name, content=result, tool_call_id=tool_call.id))
+        return None
+
+    async def text_gen_async(self, user_prompt: str, on_token: Callable[[str], None] | None = None) -> str | None:
+        if (routed := await asyncio.to_thread(self._try_fast_path, user_prompt)) is not None:
+            if on_token:
+                on_token(routed)
+            return routed
+        if user_prompt: self._messages_sent.append(UserMessage(content=user_prompt))
+        else: print("Invalid Prompt"); return None
+
+        started = time.perf_counter()
+        try:
+            return await self._stream_text_gen(on_token)
+        finally:
+            if self._router:
+                self._router.record_llm_turn(time.perf_counter() - started)
+
+    async def _stream_text_gen(self, on_token: Callable[[str], None] | None) -> str:
         while True:
-            response = self._client.chat.complete(
-                model = self.model,
-                messages = self._messages_sent,
-                tools = self.desc_of_tools if self.desc_of_tools else {},
-                tool_choice = "auto",
-                parallel_tool_calls = True
-            )
-            
-            if not response: return None
+            self._history.compact(self._messages_sent)
+            for attempt in range(RETRY_ATTEMPTS):
+                emitted: list[str] = []
+                tool_calls: list[ToolCall] = []
+                scheduled: list[asyncio.Task] = []
+
+                def emit(token: str) -> None:
+                    emitted.append(token)
+                    if on_token:
+                        on_token(token)
+
+                started = time.perf_counter()
+                try:
+                    text_response = await self._stream_turn(emit, tool_calls, scheduled)
+                    break
+                except Exception as e:
+                    # Started calls may already have written, so they finish and are answered in the history;
+                    # a retry then continues from their results instead of running them again
+                    if scheduled:
+                        await self._record_tool_results(tool_calls, scheduled)
+                    # Once tokens were shown a retry would print them twice
+                    if emitted or attempt == RETRY_ATTEMPTS - 1 or not is_retryable_error(e):
+                        raise
+                    delay = retry_delay(attempt)
+                    logging.warning(f"Mistral stream failed ({e!r}), retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+                finally:
+                    # Tool calls dispatched mid-stream overlap with this, so it is the model's share of the turn
+                    self._librarian_ins.instrumentation.record_llm(time.perf_counter() - started)
 
-            response = response.choices[0].message
-            tool_calls = response.tool_calls
             if tool_calls:
-                for tool_call in response.tool_calls:
-                    logging.warning(f"Recieved a function call!")
-                    self._messages_sent.append(AssistantMessage(tool_calls=[tool_call]))
-                    func_name = tool_call.function.name
-                    func_params = json.loads(tool_call.function.arguments)
-                    callable_func = getattr(Librarian, func_name)
-                    func_results = callable_func(self._librarian_ins, **func_params)
-                    logging.warning(f"Executed: {func_name}({func_results})\n\nReturned:{func_results}\n-----------------------------")
-                    self._messages_sent.append(ToolMessage(name=func_name, content=str(func_results), tool_call_id=tool_call.id))
+                await self._record_tool_results(tool_calls, scheduled)
                 continue
 
-            text_response = response.content
             self._messages_sent.append(AssistantMessage(content=text_response))
             return text_response
 
 class Librarian:
 
-    def __init__(self):
-        conn = sqlite3.connect("library.db")
-        conn.execute("PRAGMA foreign_keys = ON;")
-        conn.row_factory = sqlite3.Row
-        self.conn = conn
-        self.cur = self.conn.cursor()
+    def __init__(self, connections: ConnectionManager | None = None, cache: QueryCache | None = None, auth: AuthorizationSession | None = None,
+                 id_generator: TimeOrderedIdGenerator | RandomIdGenerator | None = None):
+        self._connections: ConnectionManager = connections or ConnectionManager()
+        self._id_generator: TimeOrderedIdGenerator | RandomIdGenerator = id_generator or TimeOrderedIdGenerator()
+        self._cache: QueryCache = cache or QueryCache()
+        self._auth: AuthorizationSession = auth or AuthorizationSession()
+        self._data_version: int = None
+        self._cursor: sqlite3.Cursor = None
+        self._access: ReadWriteLock = ReadWriteLock()
         self._create_tables()
+        self._run_migrations()
+        self._ensure_books_indexes()
+        self._ensure_search_index()
+        self._ensure_summary_tables()
         logging.warning("INITILISED LIBRARIAN")
 
-    @staticmethod
-    def _generate_unique_id(prefix: str = "book") -> str:
-        chars = string.ascii_lowercase + string.digits
-        random_part = ''.join(random.choice(chars) for _ in range(8))
-        return f"{prefix}_{random_part}"
+    @property
+    def conn(self) -> sqlite3.Connection:
+        return self._connections.writer()
+
+    def access(self, write: bool):
+        # Tool calls share one writer connection, so writes from different sessions must not interleave with anything
+        return self._access.write() if write else self._access.read()
+
+    @property
+    def instrumentation(self) -> Instrumentation:
+        return self._connections.instrumentation
+
+    @property
+    def cur(self) -> sqlite3.Cursor:
+        conn = self.conn
+        if self._cursor is None or self._cursor.connection is not conn:
+            self._cursor = conn.cursor()
+        return self._cursor
+
+    def _generate_unique_id(self, prefix: str = "book") -> str:
+        return self._id_generator.new(prefix)
+
+    def _insert_with_new_id(self, prefix: str, id_column: str, sql: str, params: tuple, new_id: str | None = None) -> str:
+        # The new ID is the first parameter; only a clash on the ID itself is retried, other constraint errors propagate.
+        # Bulk paths pass the ID they already drew from a batch as the first attempt
+        for attempt in range(ID_COLLISION_RETRIES):
+            new_id = new_id if attempt == 0 and new_id else self._generate_unique_id(prefix)
+            try:
+                self.cur.execute(sql, (new_id, *params))
+                return new_id
+            except sqlite3.IntegrityError as e:
+                if attempt == ID_COLLISION_RETRIES - 1 or not is_id_clash(e, id_column):
+                    raise
+                logging.warning(f"Generated {id_column} '{new_id}' already exists, retrying with a new ID")
 
     @staticmethod
-    def _format_rows_to_string(rows: list[sqlite3.Row]) -> str:
+    def _format_rows_to_string(rows: list[tuple], columns: Iterable[str] | None = None) -> str:
         if not rows:
             return "Query returned no results."
-        list_of_dicts = [dict(row) for row in rows]
-        return str(list_of_dicts)
-
+        # Records carry their own header, plain tuples need it passed in
+        columns = tuple(columns) if columns is not None else rows[0]._fields
+        date_indexes = [index for index, column in enumerate(columns) if column in DATE_COLUMNS]
+        if date_indexes:
+            def display_dates(row: tuple) -> tuple:
+                values = list(row)
+                for index in date_indexes:
+                    values[index] = to_display_date(values[index])
+                return tuple(values)
+            rows = map(display_dates, rows)
+        template = row_template(columns)
+        return "[" + ", ".join([template % row for row in rows]) + "]"
+
+    @invalidates_cache("books")
     def add_book(self, title: str, author: str, isbn: str, quantity: int) -> None:
         if not all([title, author, isbn, quantity]):
             return ("\nERROR: All fields (title, author, isbn, quantity) are required.\n")
         try:
-            book_id = self._generate_unique_id()
-            self.cur.execute('''
+            self._insert_with_new_id("book", "books.book_id", '''
                 INSERT INTO books (book_id, title, author, isbn, quantity, amount_of_times_rented)
                 VALUES (?, ?, ?, ?, ?, 0)
-            ''', (book_id, title, author, isbn, int(quantity)))
+            ''', (title, author, isbn, int(quantity)))
             self.conn.commit()
             return (f"\nSuccessfully added '{title}' by {author} to the library.\n")
-        except sqlite3.IntegrityError:
-            return (f"\nERROR: A book with ISBN '{isbn}' already exists.\n")
+        except sqlite3.IntegrityError as e:
+            self.conn.rollback()
+            if is_id_clash(e, "books.isbn"):
+                return (f"\nERROR: A book with ISBN '{isbn}' already exists.\n")
+            return (f"\nERROR: The book could not be added: {e}\n")
         except Exception as e:
+            self.conn.rollback()
             return (f"\nAn unexpected error occurred: {e}\n")
-        finally:
-            self.conn.close()
 
     def _create_tables(self) -> None:
 
@@ -155,14 +1796,160 @@ class Librarian:
                 FOREIGN KEY (book_id) REFERENCES books (book_id)
             );''')
     
+    def _run_migrations(self) -> None:
+        conn = self.conn
+        conn.commit()
+        for version, steps in SCHEMA_MIGRATIONS:
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+                continue
+            self._connections.begin_immediate()
+            try:
+                # Another process may have migrated while we waited for the lock
+                if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+                    conn.rollback()
+                    continue
+                for step in steps:
+                    step(conn) if callable(step) else conn.execute(step)
+                conn.execute(f"PRAGMA user_version = {version}")
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+            logging.warning(f"MIGRATED library.db TO SCHEMA VERSION {version}")
+        return None
+
+    def _ensure_books_indexes(self) -> None:
+        # A books.sql re-import also drops migration 1's books indexes, and user_version alone would never bring them back
+        if self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_books_author'").fetchone():
+            return None
+        logging.warning("REBUILDING books INDEXES")
+        for statement in BOOKS_INDEXES:
+            self.conn.execute(statement)
+        self.conn.commit()
+        return None
+
+    def _ensure_search_index(self) -> None:
+        # Re-importing books.sql drops the books table and its sync triggers along with it
+        if self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'books_fts_ai'").fetchone():
+            return None
+        logging.warning("REBUILDING books_fts SEARCH INDEX")
+        for statement in BOOKS_FTS_SCHEMA:
+            self.conn.execute(statement)
+        self.conn.commit()
+        return None
+
+    def _ensure_summary_tables(self) -> None:
+        # Same as the search index, a books.sql re-import drops the author_summary triggers with the books table
+        if self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'author_summary_ai'").fetchone():
+            return None
+        logging.warning("REBUILDING author_summary TABLE")
+        for statement in AUTHOR_SUMMARY_SCHEMA:
+            self.conn.execute(statement)
+        self.conn.commit()
+        return None
+
     def __enter__(self) -> Self:
-        self._initialise_from_csv("books.csv")
+        if not self.cur.execute("SELECT 1 FROM books LIMIT 1").fetchone():
+            self._initialise_from_csv("books.csv")
         return self
     
     def __exit__(self, exc_type, exc_value, traceback) -> None:
-        self.conn.commit()
-        self.conn.close()
+        self._connections.close()
         return None
+
+    def _initialise_from_csv(self, path: str) -> str | None:
+        if not os.path.exists(path):
+            return None
+        with open(path, newline='', encoding='utf-8') as file:
+            return self._bulk_load_books(csv.DictReader(file), source=path)
+
+    def _initialise_from_jsonl(self, path: str) -> str | None:
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding='utf-8') as file:
+            return self._bulk_load_books((self._parse_jsonl_line(line) for line in file if line.strip()), source=path)
+
+    @staticmethod
+    def _parse_jsonl_line(line: str) -> object:
+        # A malformed line becomes None, which _book_record_to_row rejects and counts as skipped like a bad CSV row
+        try:
+            return json.loads(line)
+        except json.JSONDecodeError:
+            return None
+
+    def bulk_import(self, path: str) -> str:
+        if not os.path.exists(path):
+            return f"\nERROR: Catalog file '{path}' not found.\n"
+        if path.lower().endswith((".jsonl", ".ndjson")):
+            return self._initialise_from_jsonl(path)
+        return self._initialise_from_csv(path)
+
+    def _book_record_to_row(self, record: dict, book_id: str | None = None) -> tuple | None:
+        if not isinstance(record, dict):
+            return None
+        try:
+            title, author, isbn = (str(record.get(key) or "").strip() for key in ("title", "author", "isbn"))
+            quantity = int(record.get("quantity") or 0)
+            times_rented = int(record.get("amount_of_times_rented") or 0)
+        except (TypeError, ValueError):
+            return None
+        if not all([title, author, isbn]) or quantity < 0:
+            return None
+        book_id = record.get("book_id") or book_id or self._generate_unique_id()
+        return (book_id, title, author, isbn, quantity, times_rented)
+
+    @invalidates_cache("books")
+    def _bulk_load_books(self, records: Iterable[dict], source: str = "catalog") -> str:
+        insert_sql = '''
+            INSERT INTO books (book_id, title, author, isbn, quantity, amount_of_times_rented)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(isbn) DO UPDATE SET quantity = quantity + excluded.quantity
+        '''
+        self.conn.commit()
+        saved_pragmas = {name: self.conn.execute(f"PRAGMA {name}").fetchone()[0] for name in BULK_LOAD_PRAGMAS}
+        for name, value in BULK_LOAD_PRAGMAS.items():
+            self.conn.execute(f"PRAGMA {name} = {value}")
+
+        books_before = self.conn.execute("SELECT count(*) FROM books").fetchone()[0]
+        loaded = skipped = 0
+        started = time.perf_counter()
+        records = iter(records)
+        try:
+            while chunk := list(islice(records, BULK_LOAD_CHUNK_SIZE)):
+                fresh_ids = self._id_generator.batch("book", len(chunk))
+                rows = [row for row in map(self._book_record_to_row, chunk, fresh_ids) if row]
+                rejected = len(chunk) - len(rows)
+                try:
+                    self.cur.executemany(insert_sql, rows)
+                except sqlite3.IntegrityError:
+                    # A clashing book_id poisons the whole batch, retry row by row to keep the rest and give generated IDs a new draw
+                    self.conn.rollback()
+                    generated = set(fresh_ids)
+                    for row in rows:
+                        try:
+                            if row[0] in generated:
+                                self._insert_with_new_id("book", "books.book_id", insert_sql, row[1:], new_id=row[0])
+                            else:
+                                self.cur.execute(insert_sql, row)
+                        except sqlite3.IntegrityError:
+                            rejected += 1
+                self.conn.commit()
+                loaded += len(chunk) - rejected
+                skipped += rejected
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            for name, value in saved_pragmas.items():
+                self.conn.execute(f"PRAGMA {name} = {value}")
+
+        elapsed = time.perf_counter() - started
+        new_books = self.conn.execute("SELECT count(*) FROM books").fetchone()[0] - books_before
+        rate = loaded / elapsed if elapsed else float(loaded)
+        summary = (f"Imported {loaded} rows from '{source}' in {elapsed:.2f}s ({rate:,.0f} rows/sec): "
+                   f"{new_books} new books, {loaded - new_books} merged into existing ISBNs, {skipped} skipped.")
+        logging.warning(summary)
+        return f"\n{summary}\n"
     
     @staticmethod
     def _format_sql_for_display(sql_template, params):
@@ -193,20 +1980,25 @@ class Librarian:
 
         return display_query
 
-    def add_user(self, full_name: str, gender: str, age: int) -> str:
+    @invalidates_cache("users")
+    def add_user(self, full_name: str, gender: str, age: int, allow_duplicate: bool = False) -> str:
         if not all([full_name, gender, age]):
             return "\nERROR: All fields (full_name, gender, age) are required.\n"
         try:
-            user_id = self._generate_unique_id(prefix="user")
-            self.cur.execute(
+            if not allow_duplicate and (duplicates := self._find_duplicate_users(self.conn, full_name)):
+                return (f"\nPossible duplicate, no user was added. Existing users with a similar name: {self._format_rows_to_string(duplicates)}\n"
+                        "If this is a different person, call add_user again with allow_duplicate=true.\n")
+            user_id = self._insert_with_new_id("user", "users.user_id",
                 "INSERT INTO users (user_id, full_name, gender, age) VALUES (?, ?, ?, ?)",
-                (user_id, full_name, gender, age)
+                (full_name, gender, age)
             )
             self.conn.commit()
             return f"\nSuccessfully added user '{full_name}' with ID '{user_id}'.\n"
         except sqlite3.Error as e:
+            self.conn.rollback()
             return f"\nAn unexpected error occurred: {e}\n"
 
+    @invalidates_cache("users")
     def delete_user(self, user_id: str) -> str:
         self.cur.execute('SELECT full_name FROM users WHERE user_id = ?', (user_id,))
         row = self.cur.fetchone()
@@ -214,7 +2006,7 @@ class Librarian:
         if not row:
             return f"\nERROR: User with ID '{user_id}' not found.\n"
 
-        user_name = row['full_name']
+        user_name = row[0]
         confirm = input(f"Are you sure you want to delete user '{user_name}' (ID: {user_id})? This will fail if they have active rentals. (yes/no): ").lower().strip()
 
         if confirm == 'yes':
@@ -226,22 +2018,24 @@ class Librarian:
                 else:
                     return f"\nERROR: Could not delete user with ID '{user_id}'.\n"
             except sqlite3.IntegrityError:
+                self.conn.rollback()
                 return f"\nERROR: Cannot delete user '{user_name}'. They are likely linked to active rental records.\n"
             except sqlite3.Error as e:
+                self.conn.rollback()
                 return f"\nAn error occurred during deletion: {e}\n"
         else:
             return "\nDeletion cancelled.\n"
 
+    @invalidates_cache("books")
     def delete_book(self, book_id: str) -> None:
 
         self.cur.execute('SELECT title FROM books WHERE book_id = ?', (book_id,))
         row = self.cur.fetchone()
 
         if not row:
-            self.conn.close()
             return (f"\nERROR: Book with ID '{book_id}' not found.\n")
 
-        book_title = row['title']
+        book_title = row[0]
         
         confirm = input(f"Are you sure you want to delete '{book_title}' (ID: {book_id})? This action cannot be undone. (yes/no): ").lower().strip()
 
@@ -250,23 +2044,27 @@ class Librarian:
                 self.cur.execute('DELETE FROM books WHERE book_id = ?', (book_id,))
                 self.conn.commit()
                 if self.cur.rowcount > 0:
-                    self.conn.close()
                     return(f"\nSuccessfully deleted '{book_title}'.\n")
                 else:
-                    self.conn.close()
                     return(f"\nERROR: Could not delete book with ID '{book_id}'.\n")
             except sqlite3.Error as e:
-                self.conn.close()
+                self.conn.rollback()
                 return(f"\nAn error occurred during deletion: {e}\n")
         else:
-            self.conn.close()
             return("\nDeletion cancelled.\n")
 
     def get_current_date(self) -> str:
-        return datetime.now().strftime("%d/%m/%Y")
+        return datetime.now().strftime(DISPLAY_DATE_FORMAT)
 
+    @invalidates_cache("rentals", "books")
     def add_rental(self, user_id: str, book_id: str, rental_date: str) -> str:
         try:
+            rental_date = to_storage_date(rental_date)
+        except (AttributeError, ValueError):
+            return f"Error: Invalid rental date '{rental_date}', expected DD/MM/YYYY."
+        try:
+            # Hold the write lock from the stock check to the update so concurrent renters cannot both take the last copy
+            self._connections.begin_immediate()
             self.cur.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
             if not self.cur.fetchone():
                 return f"Error: User with ID '{user_id}' does not exist."
@@ -276,14 +2074,12 @@ class Librarian:
             if not book_row:
                 return f"Error: Book with ID '{book_id}' does not exist."
 
-            if book_row['quantity'] < 1:
+            if book_row[0] < 1:
                 return f"Error: Book with ID '{book_id}' is out of stock."
 
-            rental_id = self._generate_unique_id(prefix="rent")
-
-            self.cur.execute(
+            rental_id = self._insert_with_new_id("rent", "rentals.rental_id",
                 "INSERT INTO rentals (rental_id, user_id, book_id, rental_date) VALUES (?, ?, ?, ?)",
-                (rental_id, user_id, book_id, rental_date)
+                (user_id, book_id, rental_date)
             )
 
             self.cur.execute(
@@ -295,20 +2091,27 @@ class Librarian:
             return f"Successfully created rental record '{rental_id}' for user '{user_id}' and book '{book_id}'."
 
         except sqlite3.Error as e:
-            self.conn.rollback() 
             return f"Database error during rental: {e}"
+        finally:
+            if self.conn.in_transaction:
+                self.conn.rollback()
 
+    @invalidates_cache("rentals", "books")
     def return_book(self, rental_id: str, return_date: str) -> str:
         try:
+            return_date = to_storage_date(return_date)
+        except (AttributeError, ValueError):
+            return f"Error: Invalid return date '{return_date}', expected DD/MM/YYYY."
+        try:
+            self._connections.begin_immediate()
             self.cur.execute("SELECT book_id, return_date FROM rentals WHERE rental_id = ?", (rental_id,))
             rental_row = self.cur.fetchone()
 
             if not rental_row:
                 return f"Error: Rental with ID '{rental_id}' not found."
-            if rental_row['return_date'] is not None:
-                return f"Error: This book was already returned on {rental_row['return_date']}."
-
-            book_id_to_return = rental_row['book_id']
+            book_id_to_return, returned_on = rental_row
+            if returned_on is not None:
+                return f"Error: This book was already returned on {to_display_date(returned_on)}."
 
             self.cur.execute(
                 "UPDATE rentals SET return_date = ? WHERE rental_id = ?",
@@ -324,48 +2127,769 @@ class Librarian:
             return f"Successfully processed return for rental ID '{rental_id}'."
 
         except sqlite3.Error as e:
-            self.conn.rollback()
             return f"Database error during return: {e}"
+        finally:
+            if self.conn.in_transaction:
+                self.conn.rollback()
+
+    def _select_in(self, sql: str, values: Iterable) -> list[tuple]:
+        values, rows = list(values), []
+        for start in range(0, len(values), SQL_IN_CHUNK_SIZE):
+            chunk = values[start:start + SQL_IN_CHUNK_SIZE]
+            rows += fetch_records(self.cur.execute(sql.format(placeholders=", ".join("?" * len(chunk))), chunk))
+        return rows
+
+    @invalidates_cache("rentals", "books")
+    def add_rentals_bulk(self, rentals: list[dict], rental_date: str) -> str:
+        try:
+            rental_date = to_storage_date(rental_date)
+        except (AttributeError, ValueError):
+            return f"Error: Invalid rental date '{rental_date}', expected DD/MM/YYYY."
+        if not rentals:
+            return "Error: No rentals were provided."
+        requests = [(item.get("user_id"), item.get("book_id")) if isinstance(item, dict) else (None, None) for item in rentals]
+
+        statuses: list[str] = [None] * len(requests)
+        try:
+            self._connections.begin_immediate()
+            known_users = {row.user_id for row in self._select_in(
+                "SELECT user_id FROM users WHERE user_id IN ({placeholders})", {user_id for user_id, _ in requests if user_id})}
+            stock = {row.book_id: row.quantity for row in self._select_in(
+                "SELECT book_id, quantity FROM books WHERE book_id IN ({placeholders})", {book_id for _, book_id in requests if book_id})}
+
+            new_rentals, created, taken = [], [], {}
+            fresh_ids = iter(self._id_generator.batch("rent", len(requests)))
+            for index, (user_id, book_id) in enumerate(requests):
+                if not user_id or not book_id:
+                    statuses[index] = "Error: Each rental needs a user_id and a book_id."
+                elif user_id not in known_users:
+                    statuses[index] = f"Error: User with ID '{user_id}' does not exist."
+                elif book_id not in stock:
+                    statuses[index] = f"Error: Book with ID '{book_id}' does not exist."
+                elif stock[book_id] - taken.get(book_id, 0) < 1:
+                    statuses[index] = f"Error: Book with ID '{book_id}' is out of stock."
+                else:
+                    taken[book_id] = taken.get(book_id, 0) + 1
+                    new_rentals.append((next(fresh_ids), user_id, book_id, rental_date))
+                    created.append(index)
+
+            insert_sql = "INSERT INTO rentals (rental_id, user_id, book_id, rental_date) VALUES (?, ?, ?, ?)"
+            self.conn.execute("SAVEPOINT bulk_rentals")
+            try:
+                self.cur.executemany(insert_sql, new_rentals)
+            except sqlite3.IntegrityError as e:
+                if not is_id_clash(e, "rentals.rental_id"):
+                    raise
+                # Undo the rows executemany got through, then insert one by one so only the clashing ID is drawn again
+                self.conn.execute("ROLLBACK TO bulk_rentals")
+                new_rentals = [(self._insert_with_new_id("rent", "rentals.rental_id", insert_sql, row[1:], new_id=row[0]), *row[1:]) for row in new_rentals]
+            self.conn.execute("RELEASE bulk_rentals")
+            for index, (rental_id, user_id, book_id, _) in zip(created, new_rentals):
+                statuses[index] = f"Created rental '{rental_id}' for user '{user_id}' and book '{book_id}'."
+            self.cur.executemany(
+                "UPDATE books SET quantity = quantity - ?, amount_of_times_rented = amount_of_times_rented + ? WHERE book_id = ?",
+                [(count, count, book_id) for book_id, count in taken.items()]
+            )
+            self.conn.commit()
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            return f"Database error during bulk rental, nothing was saved: {e}"
+        return self._format_batch_results(statuses, f"Bulk rental: {len(new_rentals)} created, {len(requests) - len(new_rentals)} failed.")
+
+    @invalidates_cache("rentals", "books")
+    def return_books_bulk(self, rental_ids: list[str], return_date: str) -> str:
+        try:
+            return_date = to_storage_date(return_date)
+        except (AttributeError, ValueError):
+            return f"Error: Invalid return date '{return_date}', expected DD/MM/YYYY."
+        if not rental_ids:
+            return "Error: No rental IDs were provided."
+
+        statuses: list[str] = [None] * len(rental_ids)
+        try:
+            self._connections.begin_immediate()
+            open_rentals = {row.rental_id: row for row in self._select_in(
+                "SELECT rental_id, book_id, return_date FROM rentals WHERE rental_id IN ({placeholders})", set(rental_ids))}
+
+            returned, restocked, seen = [], {}, set()
+            for index, rental_id in enumerate(rental_ids):
+                rental_row = open_rentals.get(rental_id)
+                if rental_id in seen:
+                    statuses[index] = f"Error: Rental '{rental_id}' is listed more than once."
+                elif not rental_row:
+                    statuses[index] = f"Error: Rental with ID '{rental_id}' not found."
+                elif rental_row.return_date is not None:
+                    statuses[index] = f"Error: Rental '{rental_id}' was already returned on {to_display_date(rental_row.return_date)}."
+                else:
+                    returned.append((return_date, rental_id))
+                    restocked[rental_row.book_id] = restocked.get(rental_row.book_id, 0) + 1
+                    statuses[index] = f"Returned rental '{rental_id}'."
+                seen.add(rental_id)
+
+            self.cur.executemany("UPDATE rentals SET return_date = ? WHERE rental_id = ? AND return_date IS NULL", returned)
+            self.cur.executemany("UPDATE books SET quantity = quantity + ? WHERE book_id = ?",
+                                 [(count, book_id) for book_id, count in restocked.items()])
+            self.conn.commit()
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            return f"Database error during bulk return, nothing was saved: {e}"
+        return self._format_batch_results(statuses, f"Bulk return: {len(returned)} returned, {len(rental_ids) - len(returned)} failed.")
+
+    def get_books_by_author(self, author: str, limit: int = 50) -> str:
+        terms = re.findall(r"\w+", str(author or "").lower())
+        if not terms:
+            return "Error: get_books_by_author needs an author name."
+        query = '''
+            SELECT b.book_id, b.title, b.author, b.isbn, b.quantity
+            FROM books_fts JOIN books b ON b.rowid = books_fts.rowid
+            WHERE books_fts MATCH ?
+            ORDER BY b.author, b.title
+            LIMIT ?
+        '''
+        try:
+            with self._connections.reader() as conn:
+                columns, rows = fetch_rows(conn.execute(query, ("author : (" + " ".join(f'"{term}"*' for term in terms) + ")", max(1, min(int(limit), 200)))))
+        except sqlite3.Error as e:
+            return f"Error fetching books by author: {e}"
+        return self._format_rows_to_string(rows, columns)
+
+    def _read_summary(self, query: str, params: tuple, label: str) -> str:
+        try:
+            with self._connections.reader() as conn:
+                columns, rows = fetch_rows(conn.execute(query, params))
+        except sqlite3.Error as e:
+            return f"Error fetching {label}: {e}"
+        return self._format_rows_to_string(rows, columns)
+
+    @staticmethod
+    def _summary_limit(limit: int) -> int:
+        return max(1, min(int(limit), SUMMARY_MAX_LIMIT))
+
+    def get_user_rental_summary(self, user_id: str | None = None, order_by: str = "active", limit: int = SUMMARY_DEFAULT_LIMIT) -> str:
+        select = '''
+            SELECT s.user_id, u.full_name, s.active_rentals, s.total_rentals
+            FROM user_rental_summary s LEFT JOIN users u ON u.user_id = s.user_id
+        '''
+        if user_id:
+            return self._read_summary(select + "WHERE s.user_id = ?", (user_id,), "user rental summary")
+        if order_by not in ("active", "total"):
+            return "Error: order_by must be 'active' or 'total'."
+        column = "active_rentals" if order_by == "active" else "total_rentals"
+        return self._read_summary(select + f"ORDER BY s.{column} DESC, s.user_id LIMIT ?", (self._summary_limit(limit),), "user rental summary")
+
+    def get_author_availability(self, author: str | None = None, limit: int = SUMMARY_DEFAULT_LIMIT) -> str:
+        select = "SELECT author, titles, titles_in_stock, copies_in_stock, times_rented FROM author_summary "
+        if not author:
+            return self._read_summary(select + "ORDER BY times_rented DESC, author LIMIT ?", (self._summary_limit(limit),), "author availability")
+        exact = self._read_summary(select + "WHERE author = ?", (author.strip(),), "author availability")
+        if exact != "Query returned no results.":
+            return exact
+        # The exact match is a primary-key lookup, a partial name falls back to scanning the (much smaller) author list
+        return self._read_summary(select + "WHERE author LIKE ? ORDER BY times_rented DESC LIMIT ?",
+                                  (f"%{author.strip()}%", self._summary_limit(limit)), "author availability")
+
+    def get_monthly_rentals(self, months: int = 12) -> str:
+        return self._read_summary("SELECT month, rentals, returns FROM monthly_rental_summary ORDER BY month DESC LIMIT ?",
+                                  (max(1, min(int(months), 120)),), "monthly rentals")
+
+    def get_popular_books(self, limit: int = SUMMARY_DEFAULT_LIMIT) -> str:
+        return self._read_summary('''
+            SELECT book_id, title, author, quantity, amount_of_times_rented
+            FROM books ORDER BY amount_of_times_rented DESC, book_id LIMIT ?
+        ''', (self._summary_limit(limit),), "popular books")
+
+    def _fetch_rentals(self, where: str, params: tuple, limit: int = RENTALS_DEFAULT_LIMIT, offset: int = 0) -> str:
+        limit, offset = max(1, min(int(limit), RENTALS_MAX_LIMIT)), max(0, int(offset))
+        query = f'''
+            SELECT r.rental_id, r.user_id, u.full_name, r.book_id, b.title, r.rental_date, r.return_date
+            FROM rentals r
+            JOIN users u ON u.user_id = r.user_id
+            JOIN books b ON b.book_id = r.book_id
+            WHERE {where}
+            ORDER BY r.rental_date, r.rental_id
+            LIMIT ? OFFSET ?
+        '''
+        try:
+            with self._connections.reader() as conn:
+                columns, rows = fetch_rows(conn.execute(query, (*params, limit + 1, offset)))
+        except sqlite3.Error as e:
+            return f"Error fetching rentals: {e}"
+        more = f"\nMore rentals available, call again with offset={offset + limit}." if len(rows) > limit else ""
+        return self._format_rows_to_string(rows[:limit], columns) + more
+
+    def get_overdue_rentals(self, loan_days: int = 14, as_of: str | None = None, limit: int = RENTALS_DEFAULT_LIMIT, offset: int = 0) -> str:
+        try:
+            as_of_date = datetime.strptime(to_storage_date(as_of), STORAGE_DATE_FORMAT) if as_of else datetime.now()
+            cutoff = (as_of_date - timedelta(days=int(loan_days))).strftime(STORAGE_DATE_FORMAT)
+        except (AttributeError, TypeError, ValueError, OverflowError):
+            return f"Error: Invalid arguments loan_days='{loan_days}', as_of='{as_of}'. loan_days must be a number of days within the calendar and as_of a DD/MM/YYYY date."
+        return self._fetch_rentals("r.return_date IS NULL AND r.rental_date < ?", (cutoff,), limit, offset)
+
+    def get_rentals_between(self, start_date: str, end_date: str, active_only: bool = False, limit: int = RENTALS_DEFAULT_LIMIT, offset: int = 0) -> str:
+        try:
+            start, end = to_storage_date(start_date), to_storage_date(end_date)
+        except (AttributeError, ValueError):
+            return f"Error: Invalid date range '{start_date}' - '{end_date}', expected DD/MM/YYYY."
+        if active_only:
+            return self._fetch_rentals("r.return_date IS NULL AND r.rental_date BETWEEN ? AND ?", (start, end), limit, offset)
+        return self._fetch_rentals("r.rental_date BETWEEN ? AND ?", (start, end), limit, offset)
+
+    @staticmethod
+    def _user_candidates(conn: sqlite3.Connection, words: list[str]) -> list[tuple[tuple, list[str]]]:
+        select = '''
+            SELECT u.user_id, u.full_name, u.gender, u.age, COALESCE(s.active_rentals, 0) AS active_rentals
+            FROM users_fts JOIN users u ON u.rowid = users_fts.rowid
+            LEFT JOIN user_rental_summary s ON s.user_id = u.user_id
+            WHERE users_fts MATCH ?
+            ORDER BY bm25(users_fts)
+            LIMIT ?
+        '''
+        # Every word as a prefix, then the first two letters of every word (a typo later on), then any one word (a typo early on, or a word too many)
+        stages = (" ".join(f'"{word}"*' for word in words), " ".join(f'"{word[:2]}"*' for word in words), " OR ".join(f'"{word}"*' for word in words))
+        candidates, seen = [], set()
+        for match in dict.fromkeys(stages):
+            for row in fetch_records(conn.execute(select, (match, USER_MATCH_CANDIDATES))):
+                if row.user_id not in seen:
+                    seen.add(row.user_id)
+                    candidates.append((row, normalize_name(row.full_name)))
+            # A name containing every word as typed cannot be beaten, so there is no need to widen further
+            if len(candidates) >= USER_MATCH_CANDIDATES or any(name_similarity(words, other) == 1.0 for _, other in candidates):
+                break
+        return candidates
+
+    def _find_duplicate_users(self, conn: sqlite3.Connection, full_name: str) -> list[tuple]:
+        # Both directions must match, so "John" is not a duplicate of "John Smith" but "Jon Smith" is
+        words = normalize_name(full_name)
+        if not words:
+            return []
+        return [row for row, other in self._user_candidates(conn, words)
+                if min(name_similarity(words, other), name_similarity(other, words)) >= USER_DUPLICATE_MIN_SCORE]
+
+    def find_user(self, name: str, limit: int = 5) -> str:
+        words = normalize_name(name)
+        if not words:
+            return "Error: find_user needs at least one word of the user's name."
+        limit = max(1, min(int(limit), 50))
+        try:
+            with self._connections.reader() as conn:
+                candidates = self._user_candidates(conn, words)
+        except sqlite3.Error as e:
+            return f"Error finding user: {e}"
+
+        scored = []
+        for row, other in candidates:
+            # Mostly how well the query is covered, with a little weight on extra words in the stored name
+            score = 0.8 * name_similarity(words, other) + 0.2 * name_similarity(other, words)
+            if score >= USER_MATCH_MIN_SCORE:
+                scored.append((*row, round(score, 2)))
+        scored.sort(key=lambda user: (-user[-1], user[1], user[0]))
+        return self._format_rows_to_string(scored[:limit], (*candidates[0][0]._fields, "match") if candidates else ())
+
+    @staticmethod
+    def _fuzzy_score(terms: list[str], row: tuple) -> float:
+        words = re.findall(r"\w+", f"{row.title} {row.author}".lower())
+        if not words:
+            return 0.0
+        return sum(max(SequenceMatcher(None, term, word).ratio() for word in words) for term in terms) / len(terms)
+
+    def search_books(self, query: str, limit: int = 10, offset: int = 0, fuzzy: bool = True) -> str:
+        terms = re.findall(r"\w+", str(query or "").lower())
+        if not terms:
+            return "Error: search_books needs at least one word to search for."
+        limit, offset = max(1, min(int(limit), 50)), max(0, int(offset))
+        select = '''
+            SELECT b.book_id, b.title, b.author, b.isbn, b.quantity
+            FROM books_fts JOIN books b ON b.rowid = books_fts.rowid
+            WHERE books_fts MATCH ?
+            ORDER BY bm25(books_fts, 10.0, 5.0, 1.0)
+            LIMIT ? OFFSET ?
+        '''
+        try:
+            with self._connections.reader() as conn:
+                rows = fetch_records(conn.execute(select, (" ".join(f'"{term}"*' for term in terms), limit + 1, offset)))
+                if rows or not fuzzy:
+                    more = f"\nMore results available, call again with offset={offset + limit}." if len(rows) > limit else ""
+                    return self._format_rows_to_string(rows[:limit]) + more
+
+                candidate_match = " OR ".join(f'"{term[:3]}"*' for term in terms)
+                candidates = fetch_records(conn.execute(select, (candidate_match, SEARCH_FUZZY_CANDIDATES, 0)))
+        except sqlite3.Error as e:
+            return f"Error searching books: {e}"
+
+        scored = sorted(((self._fuzzy_score(terms, row), row) for row in candidates), key=lambda pair: -pair[0])
+        matches = [row for score, row in scored if score >= SEARCH_FUZZY_MIN_SCORE][offset:offset + limit]
+        if not matches:
+            return "Query returned no results."
+        return "No exact matches, closest titles:\n" + self._format_rows_to_string(matches)
+
+    def _authorisation_denied(self) -> str:
+        if not self._auth.interactive:
+            # No password was asked for, so there is nothing to report at a terminal
+            return "Authorisation unavailable: privileged operations need the admin password at the librarian's terminal. Nothing was executed."
+        print("INVALID PASSWORD! ABORTING")
+        return "User entered the wrong password to authorise this action. Nothing was executed."
 
     def execute_sql(self, prompt: str, params: tuple = ()) -> str:
+        try:
+            return self._execute_sql(prompt, params)
+        finally:
+            self._cache.invalidate(QueryCache.tables_written(prompt))
 
-        passkey_input = getpass(f"You are about to execute '{Librarian._format_sql_for_display(prompt, params)}' This is an irreverasable change!\nEnter your password to confirm: ")
-        if not check_password(passkey_input): print("INVALID PASSWORD! ABORTING"); return "User entered te wrong password to authorise this action"
+    def _execute_sql(self, prompt: str, params: tuple = ()) -> str:
+
+        if not self._auth.authorize(Librarian._format_sql_for_display(prompt, params)): return self._authorisation_denied()
 
         try:
             self.cur.execute(prompt, tuple(params))
             if self.cur.description:
-                return self._format_rows_to_string(self.cur.fetchall())
+                result = self._format_rows_to_string(self.cur.fetchall(), column_names(self.cur))
+                self.conn.commit()
+                return result
+            self.conn.commit()
             return "SQL executed successfully, no rows returned."
         except sqlite3.Error as e:
+            self.conn.rollback()
             return f"Error executing SQL: {e}"
 
-    def mass_execute(self, operations: list[tuple[str, tuple]]) -> str:
-        results = []
-        passkey_input = getpass(f"You are about to execute '{"\n\n".join([Librarian._format_sql_for_display(prompt, params) for prompt, params in operations])}' This is an irreverasable change!\nEnter your password to confirm: ")
-        if not check_password(passkey_input): print("INVALID PASSWORD! ABORTING"); return "User entered the wrong password to authorise this action"
-        for prompt, params in operations:
-            try:
-                self.cur.execute(prompt, tuple(params))
-                if self.cur.description:
-                    results.append(str(self.cur.fetchall()))
+    def mass_execute(self, operations: list[tuple[str, tuple]], atomic: bool = False) -> str:
+        try:
+            return self._mass_execute(operations, atomic)
+        finally:
+            written = [QueryCache.tables_written(prompt) for prompt, _ in operations]
+            self._cache.invalidate(None if None in written else frozenset().union(*written))
+
+    @staticmethod
+    def _group_operations(operations: list[tuple[str, tuple]]) -> list[tuple[str, list[int], list[tuple]]]:
+        groups: list[tuple[str, list[int], list[tuple]]] = []
+        for index, (prompt, params) in enumerate(operations):
+            if groups and groups[-1][0] == prompt and DML_PATTERN.match(prompt):
+                groups[-1][1].append(index)
+                groups[-1][2].append(tuple(params))
+            else:
+                groups.append((prompt, [index], [tuple(params)]))
+        return groups
+
+    def _run_operation(self, savepoint: str, prompt: str, params: tuple) -> str:
+        self.conn.execute(f"SAVEPOINT {savepoint}")
+        try:
+            self.cur.execute(prompt, params)
+            result = self._format_rows_to_string(self.cur.fetchall(), column_names(self.cur)) if self.cur.description else f"OK, {max(self.cur.rowcount, 0)} rows affected."
+        except sqlite3.Error:
+            self.conn.execute(f"ROLLBACK TO {savepoint}")
+            raise
+        finally:
+            self.conn.execute(f"RELEASE {savepoint}")
+        return result
+
+    def _mass_execute(self, operations: list[tuple[str, tuple]], atomic: bool = False) -> str:
+        if not self._auth.authorize("\n\n".join([Librarian._format_sql_for_display(prompt, params) for prompt, params in operations])): return self._authorisation_denied()
+        if not operations:
+            return "No operations to execute."
+
+        not_run = "Not executed, the batch was rolled back."
+        results: list[str] = [not_run] * len(operations)
+        failures = 0
+        conn = self.conn
+        try:
+            self._connections.begin_immediate()
+            for number, (prompt, indexes, param_rows) in enumerate(self._group_operations(operations)):
+                savepoint = f"batch_{number}"
+                if len(indexes) > 1:
+                    conn.execute(f"SAVEPOINT {savepoint}")
+                    try:
+                        affected = conn.executemany(prompt, param_rows).rowcount
+                        conn.execute(f"RELEASE {savepoint}")
+                        for index in indexes:
+                            results[index] = f"OK, executed as part of a batch of {len(indexes)} ({affected} rows affected in total)."
+                        continue
+                    except sqlite3.Error:
+                        # Replay the group one statement at a time to find out which ones failed
+                        conn.execute(f"ROLLBACK TO {savepoint}")
+                        conn.execute(f"RELEASE {savepoint}")
+                for offset, (index, params) in enumerate(zip(indexes, param_rows)):
+                    try:
+                        results[index] = self._run_operation(f"{savepoint}_{offset}", prompt, params)
+                    except sqlite3.Error as e:
+                        failures += 1
+                        results[index] = f"Error executing SQL: {e}"
+                        if atomic:
+                            conn.rollback()
+                            results = [result if result is not_run or position == index else f"Rolled back because operation {index + 1} failed."
+                                       for position, result in enumerate(results)]
+                            return self._format_batch_results(results, f"Batch rolled back, operation {index + 1} failed.")
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            return f"Error executing batch, nothing was applied: {e}"
+        return self._format_batch_results(results, f"Batch committed: {len(operations) - failures} succeeded, {failures} failed.")
+
+    @staticmethod
+    def _format_batch_results(results: list[str], summary: str) -> str:
+        return summary + "\n" + "\n".join(f"[{number}] {result}" for number, result in enumerate(results, start=1))
+
+    @staticmethod
+    def _query_fingerprint(prompt: str, params: tuple) -> str:
+        normalised = json.dumps([" ".join(prompt.split()), list(params)], default=str)
+        return hashlib.sha1(normalised.encode("utf-8")).hexdigest()[:12]
+
+    @staticmethod
+    def _encode_cursor(fingerprint: str, position: dict) -> str:
+        token = json.dumps({"q": fingerprint, **position}, separators=(",", ":"), default=str)
+        return base64.urlsafe_b64encode(token.encode("utf-8")).decode("ascii").rstrip("=")
+
+    @staticmethod
+    def _decode_cursor(token: str, fingerprint: str) -> dict:
+        position = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        if not isinstance(position, dict) or position.pop("q", None) != fingerprint:
+            raise ValueError("the cursor belongs to a different prompt or params")
+        return position
+
+    @staticmethod
+    def _build_page_query(conn: sqlite3.Connection, prompt: str, params: tuple, limit: int, position: dict) -> tuple[str, tuple, int | None] | None:
+        inner = prompt.strip().rstrip(";")
+        try:
+            columns = [column[0] for column in conn.execute(f"SELECT * FROM ({inner}) LIMIT 0", params).description]
+        except sqlite3.Error:
+            return None
+        key = next((column for column in KEYSET_COLUMNS if columns.count(column) == 1), None)
+        if key and not ORDER_BY_PATTERN.search(inner):
+            skip = int(position.get("skip", 0))
+            if "after" in position:
+                return (f'SELECT * FROM ({inner}) WHERE "{key}" >= ? ORDER BY "{key}" LIMIT ?',
+                        (*params, position["after"], skip + limit + 1), columns.index(key))
+            return f'SELECT * FROM ({inner}) ORDER BY "{key}" LIMIT ?', (*params, limit + 1), columns.index(key)
+        return f"SELECT * FROM ({inner}) LIMIT ? OFFSET ?", (*params, limit + 1, int(position.get("offset", 0))), None
+
+    @staticmethod
+    def _stream_rows(cursor: sqlite3.Cursor, limit: int, output_format: str, key_index: int | None = None,
+                     skip: int = 0, last_key=None, byte_budget: int = FETCH_BYTE_BUDGET) -> tuple[str, int, bool, object, int]:
+        columns = [column[0] for column in cursor.description]
+        date_indexes = [index for index, column in enumerate(columns) if column in DATE_COLUMNS]
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        if output_format != "jsonl":
+            writer.writerow(columns)
+        shown, more, run = 0, False, skip
+        while not more and (batch := cursor.fetchmany(FETCH_BATCH_SIZE)):
+            for row in batch:
+                if skip:
+                    skip -= 1
+                    continue
+                if shown >= limit or buffer.tell() >= byte_budget:
+                    more = True
+                    break
+                values = list(row)
+                for index in date_indexes:
+                    values[index] = to_display_date(values[index])
+                if output_format == "jsonl":
+                    buffer.write(json.dumps(dict(zip(columns, values)), ensure_ascii=False, default=str) + "\n")
                 else:
-                    results.append("SQL executed successfully, no rows returned.")
-            except sqlite3.Error as e:
-                results.append(f"Error executing SQL: {e}")
-        return self._format_rows_to_string(results)
+                    writer.writerow(values)
+                if key_index is not None:
+                    run = run + 1 if row[key_index] == last_key else 1
+                    last_key = row[key_index]
+                shown += 1
+        return buffer.getvalue(), shown, more, last_key, run
+
+    def _fetch_page(self, conn: sqlite3.Connection, prompt: str, params: tuple, limit: int, position: dict, output_format: str) -> str:
+        self.instrumentation.capture_plan(conn, prompt, params)
+        page_query = self._build_page_query(conn, prompt, params, limit, position)
+        if page_query is None:
+            # Statements that cannot be wrapped in a sub-select (PRAGMA, EXPLAIN, ...) are only capped
+            text, shown, more, _, _ = self._stream_rows(conn.execute(prompt, params), limit, output_format)
+            if not shown:
+                return "Query returned no results."
+            return text + (f"-- {shown} rows shown, the rest were cut off. Narrow the query to see more.\n" if more else "")
+
+        sql, args, key_index = page_query
+        skip = int(position.get("skip", 0)) if key_index is not None else 0
+        text, shown, more, last_key, run = self._stream_rows(conn.execute(sql, args), limit, output_format,
+                                                             key_index, skip, position.get("after"))
+        if not shown:
+            return "Query returned no results."
+        if not more:
+            return text + f"-- {shown} rows, end of results.\n"
+        next_position = {"after": last_key, "skip": run} if key_index is not None else {"offset": int(position.get("offset", 0)) + shown}
+        token = self._encode_cursor(self._query_fingerprint(prompt, params), next_position)
+        return text + f"-- {shown} rows shown, more available. Call fetch_data again with the same prompt and params and cursor='{token}'.\n"
+
+    def _check_external_writes(self) -> None:
+        # data_version only moves when *another* connection commits, e.g. a second librarian terminal
+        data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if self._data_version is not None and data_version != self._data_version:
+            self._cache.invalidate()
+        self._data_version = data_version
+        return None
 
-    def fetch_data(self, prompt: str, params: tuple = ()) -> str:
+    def fetch_data(self, prompt: str, params: tuple = (), limit: int = FETCH_ROW_LIMIT, cursor: str | None = None, output_format: str = "csv") -> str:
+        params = tuple(params)
         try:
-            self.cur.execute(prompt, tuple(params))
-            return self._format_rows_to_string(self.cur.fetchall())
+            limit = max(1, min(int(limit), FETCH_MAX_ROW_LIMIT))
+            position = self._decode_cursor(cursor, self._query_fingerprint(prompt, params)) if cursor else {}
+        except (TypeError, ValueError) as e:
+            return f"Error fetching data: invalid limit or cursor ({e})"
+        if self.conn.in_transaction:
+            return self._fetch_data(prompt, params, limit, position, output_format)
+
+        self._check_external_writes()
+        key = QueryCache.make_key(prompt, params, limit, cursor, output_format)
+        if (cached := self._cache.get(key)) is not None:
+            return cached
+        generation = self._cache.generation
+        result = self._fetch_data(prompt, params, limit, position, output_format)
+        if not result.startswith("Error"):
+            self._cache.put(key, QueryCache.tables_read(prompt), result, generation)
+        return result
+
+    def _fetch_data(self, prompt: str, params: tuple, limit: int, position: dict, output_format: str) -> str:
+        try:
+            if self.conn.in_transaction:
+                # Uncommitted writes (e.g. from mass_execute) are only visible on the writer
+                self.conn.execute("PRAGMA query_only = ON;")
+                try:
+                    return self._fetch_page(self.conn, prompt, params, limit, position, output_format)
+                finally:
+                    self.conn.execute("PRAGMA query_only = OFF;")
+            with self._connections.reader() as conn:
+                return self._fetch_page(conn, prompt, params, limit, position, output_format)
         except sqlite3.Error as e:
             return f"Error fetching data: {e}"
 
-    
-if __name__ == "__main__":
 
-    tools_json = [
+class BoundedExecutor:
+    # A worker pool that refuses work instead of queueing without limit, so overload turns into 503s rather than timeouts
+    def __init__(self, workers: int, queue_size: int, name: str):
+        self.workers: int = workers
+        self.queue_size: int = queue_size
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+        self.in_flight: int = 0
+        self.rejected: int = 0
+
+    def submit(self, func: Callable, *args) -> Future | None:
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            return None
+        with self._lock:
+            self.in_flight += 1
+        future = self._executor.submit(func, *args)
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, future: Future) -> None:
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+        return None
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {"workers": self.workers, "queue_size": self.queue_size, "in_flight": self.in_flight, "rejected": self.rejected}
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        return None
+
+class ChatSession:
+    def __init__(self, chat: Mistral_Ai):
+        self.chat: Mistral_Ai = chat
+        self.lock = threading.Lock()
+        self.last_used: float = time.monotonic()
+
+class LibraryRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "LibrarianHTTP/1.0"
+    # Headers and body are separate writes, with Nagle the body waits on the client's delayed ACK of the headers
+    disable_nagle_algorithm = True
+
+    def do_GET(self) -> None:
+        self.server.app.handle(self, "GET")
+
+    def do_POST(self) -> None:
+        self.server.app.handle(self, "POST")
+
+    def do_DELETE(self) -> None:
+        self.server.app.handle(self, "DELETE")
+
+    def read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > SERVER_MAX_BODY:
+            raise ValueError(f"request body is larger than {SERVER_MAX_BODY} bytes")
+        payload = json.loads(self.rfile.read(length) or b"{}") if length else {}
+        if not isinstance(payload, dict):
+            raise ValueError("the request body must be a JSON object")
+        return payload
+
+    def send_json(self, status: int, payload: dict, headers: dict[str, str] | None = None) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        return None
+
+    def log_message(self, format: str, *args) -> None:
+        logging.info(f"HTTP {self.address_string()} {format % args}")
+        return None
+
+class LibraryServer:
+    def __init__(self, engine: Mistral_Ai, host: str = "127.0.0.1", port: int = 8080, chat_workers: int = SERVER_CHAT_WORKERS,
+                 sqlite_workers: int = SERVER_SQLITE_WORKERS, queue_size: int = SERVER_QUEUE_SIZE,
+                 session_ttl: float = SERVER_SESSION_TTL, max_sessions: int = SERVER_MAX_SESSIONS):
+        self._engine: Mistral_Ai = engine
+        self._librarian: Librarian = engine._librarian_ins
+        # Privileged and confirming tools prompt at a terminal, which would block a worker thread with nobody to answer
+        self.tool_names: list[str] = [name for name in engine.tools if name not in PRIVILEGED_TOOLS | CONFIRMING_TOOLS]
+        self._tool_descriptions = [tool for tool in engine.desc_of_tools or [] if tool["function"]["name"] in self.tool_names]
+        self._registry: ToolRegistry = ToolRegistry(self._librarian, self._tool_descriptions, self.tool_names)
+        self._chat_pool = BoundedExecutor(chat_workers, queue_size, "librarian-chat")
+        self._sqlite_pool = BoundedExecutor(sqlite_workers, queue_size, "librarian-sqlite")
+        self._sessions: dict[str, ChatSession] = {}
+        self._sessions_lock = threading.Lock()
+        self.session_ttl: float = session_ttl
+        self.max_sessions: int = max_sessions
+        self._httpd = ThreadingHTTPServer((host, port), LibraryRequestHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.app = self
+
+    @property
+    def address(self) -> tuple[str, int]:
+        return self._httpd.server_address[:2]
+
+    def serve_forever(self) -> None:
+        try:
+            self._httpd.serve_forever()
+        finally:
+            self._httpd.server_close()
+            self._chat_pool.shutdown()
+            self._sqlite_pool.shutdown()
+        return None
+
+    def shutdown(self) -> None:
+        self._httpd.shutdown()
+        return None
+
+    def handle(self, request: LibraryRequestHandler, method: str) -> None:
+        parts = [part for part in urlsplit(request.path).path.split("/") if part]
+        try:
+            if method == "GET" and parts == ["health"]:
+                status, payload = 200, {"status": "ok", "sessions": len(self._sessions),
+                                        "chat_pool": self._chat_pool.stats(), "sqlite_pool": self._sqlite_pool.stats()}
+            elif method == "GET" and parts == ["stats"]:
+                status, payload = 200, self._librarian.instrumentation.summary()
+            elif method == "GET" and parts == ["tools"]:
+                status, payload = 200, {"tools": self.tool_names}
+            elif method == "POST" and len(parts) == 2 and parts[0] == "tools":
+                status, payload = self._run(self._sqlite_pool, self._call_tool, parts[1], request.read_json())
+            elif method == "POST" and parts == ["sessions"]:
+                status, payload = self._create_session()
+            elif method == "POST" and len(parts) == 3 and parts[0] == "sessions" and parts[2] == "messages":
+                status, payload = self._run(self._chat_pool, self._chat, parts[1], request.read_json().get("content"))
+            elif method == "DELETE" and len(parts) == 2 and parts[0] == "sessions":
+                with self._sessions_lock:
+                    removed = self._sessions.pop(parts[1], None)
+                status, payload = (200, {"deleted": parts[1]}) if removed else (404, {"error": f"Unknown session '{parts[1]}'."})
+            else:
+                status, payload = 404, {"error": f"No route for {method} {request.path}"}
+        except ValueError as e:
+            status, payload = 400, {"error": f"Bad request: {e}"}
+        if status == 503:
+            request.send_json(status, payload, {"Retry-After": "1"})
+        else:
+            request.send_json(status, payload)
+        return None
+
+    def _run(self, pool: BoundedExecutor, func: Callable, *args) -> tuple[int, dict]:
+        future = pool.submit(func, *args)
+        if future is None:
+            return 503, {"error": "The server is busy, retry shortly."}
+        try:
+            return future.result(timeout=SERVER_REQUEST_TIMEOUT)
+        except FutureTimeoutError:
+            return 504, {"error": f"The request did not finish within {SERVER_REQUEST_TIMEOUT:.0f}s."}
+        except Exception as e:
+            logging.exception("Server request failed")
+            return 500, {"error": f"Internal error: {e}"}
+
+    def _call_tool(self, name: str, arguments: dict) -> tuple[int, dict]:
+        if name not in self.tool_names:
+            return 404, {"error": f"Unknown or unavailable tool '{name}'."}
+        callable_func, arguments, problems = self._registry.prepare(name, arguments)
+        if problems:
+            return 400, json.loads(self._registry.error_message(name, problems))
+        return 200, {"tool": name, "result": self._engine._invoke_tool(name, callable_func, arguments)}
+
+    def _create_session(self) -> tuple[int, dict]:
+        now = time.monotonic()
+        with self._sessions_lock:
+            for session_id in [key for key, session in self._sessions.items() if now - session.last_used > self.session_ttl]:
+                del self._sessions[session_id]
+            if len(self._sessions) >= self.max_sessions:
+                return 503, {"error": "Too many open sessions, retry shortly."}
+            chat = self._engine.fork()
+            chat.desc_of_tools = self._tool_descriptions
+            chat.tools = self.tool_names
+            chat._registry = self._registry
+            # Session IDs grant access to a conversation, so they are fully random rather than time-ordered
+            session_id = f"sess_{secrets.token_hex(16)}"
+            self._sessions[session_id] = ChatSession(chat)
+        return 201, {"session_id": session_id}
+
+    def _chat(self, session_id: str, content: str | None) -> tuple[int, dict]:
+        with self._sessions_lock:
+            session = self._sessions.get(session_id)
+        if session is None:
+            return 404, {"error": f"Unknown session '{session_id}'."}
+        if not isinstance(content, str) or not content.strip():
+            return 400, {"error": "Bad request: 'content' must be a non-empty string."}
+        # One turn at a time per conversation, the message list is not safe to extend concurrently
+        with session.lock:
+            session.last_used = time.monotonic()
+            try:
+                reply = session.chat.text_gen(content)
+            except (httpx.TransportError, SDKError) as e:
+                return 502, {"error": f"The language model could not be reached: {e}"}
+        return 200, {"session_id": session_id, "reply": reply}
+
+def handle_cli_command(mist_cli: Mistral_Ai, command: str) -> bool:
+    if command.strip() == "/cache":
+        print(f"\n{json.dumps(mist_cli._librarian_ins._cache.stats(), indent=2)}\n")
+        return True
+    if command.strip() == "/stats":
+        print(f"\n{json.dumps(mist_cli._librarian_ins.instrumentation.summary(), indent=2)}\n")
+        return True
+    if command.strip() == "/router":
+        metrics = mist_cli._router.metrics() if mist_cli._router else "The fast path is disabled, start with --fast-path to enable it."
+        print(f"\n{json.dumps(metrics, indent=2)}\n")
+        return True
+    if command.strip() == "/lock":
+        mist_cli._librarian_ins._auth.revoke()
+        print("\nAdmin session locked, the next privileged operation will ask for the password again.\n")
+        return True
+    return False
+
+async def run_async_cli(mist_cli: Mistral_Ai) -> None:
+    try:
+        while True:
+            command = await ainput("<<YOU>>: ")
+            if handle_cli_command(mist_cli, command):
+                continue
+            print(f"\n<<Library Assistant>>:\n--------------------")
+            try:
+                await mist_cli.text_gen_async(command, on_token=lambda token: print(token, end="", flush=True))
+                print("\n")
+            except httpx.TransportError:
+                print(f"\nYour internet connection is not stable. Please try again in a few minutes\n")
+    finally:
+        await mist_cli.aclose()
+
+    
+TOOLS_JSON = [
     {
         "type": "function",
         "function": {
@@ -423,22 +2947,114 @@ if __name__ == "__main__":
             }
         }
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "add_rentals_bulk",
+            "description": "Creates many rentals in one call, e.g. for a queue at the desk. All rentals share the same rental date. Each item gets its own status line, so one bad item does not stop the others.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "rentals": {
+                        "type": "array",
+                        "description": "The rentals to create.",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "user_id": { "type": "string", "description": "The unique ID of the user renting the book." },
+                                "book_id": { "type": "string", "description": "The unique ID of the book being rented." }
+                            },
+                            "required": ["user_id", "book_id"]
+                        }
+                    },
+                    "rental_date": { "type": "string", "description": "The date of the rentals in DD/MM/YYYY format, obtained from get_current_date." }
+                },
+                "required": ["rentals", "rental_date"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "return_books_bulk",
+            "description": "Processes many returns in one call, e.g. emptying the drop box. All returns share the same return date. Each rental ID gets its own status line, so one bad ID does not stop the others.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "rental_ids": { "type": "array", "description": "The unique IDs of the rental records being completed.", "items": { "type": "string" } },
+                    "return_date": { "type": "string", "description": "The date of the returns in DD/MM/YYYY format, obtained from get_current_date." }
+                },
+                "required": ["rental_ids", "return_date"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_overdue_rentals",
+            "description": "Lists the rentals that have not been returned and were rented more than loan_days days ago, oldest first, with the renter's name and the book title. Use this for any overdue question instead of raw SQL.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "loan_days": { "type": "integer", "description": "The loan period in days. Defaults to 14." },
+                    "as_of": { "type": "string", "description": "Optional reference date in DD/MM/YYYY format. Defaults to today." },
+                    "limit": { "type": "integer", "description": "Maximum number of rentals to return (1-200). Defaults to 50." },
+                    "offset": { "type": "integer", "description": "Number of rentals to skip, used to fetch the next page. Defaults to 0." }
+                },
+                "required": []
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_rentals_between",
+            "description": "Lists rentals whose rental date falls between start_date and end_date (inclusive), with the renter's name and the book title. Use this for questions like 'rentals this month'.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "start_date": { "type": "string", "description": "The first day of the range in DD/MM/YYYY format." },
+                    "end_date": { "type": "string", "description": "The last day of the range in DD/MM/YYYY format." },
+                    "active_only": { "type": "boolean", "description": "If true, only include rentals that have not been returned yet." },
+                    "limit": { "type": "integer", "description": "Maximum number of rentals to return (1-200). Defaults to 50." },
+                    "offset": { "type": "integer", "description": "Number of rentals to skip, used to fetch the next page. Defaults to 0." }
+                },
+                "required": ["start_date", "end_date"]
+            }
+        }
+    },
     {
         "type": "function",
         "function": {
             "name": "add_user",
-            "description": "Adds a new user (renter) to the database with a specific full name, gender, and age.",
+            "description": "Adds a new user (renter) to the database with a specific full name, gender, and age. If a user with a very similar name already exists, nothing is added and the existing matches are returned instead.",
             "parameters": {
                 "type": "object",
                 "properties": {
                     "full_name": { "type": "string", "description": "The user's full name." },
                     "gender": { "type": "string", "description": "The user's gender." },
-                    "age": { "type": "integer", "description": "The user's age." }
+                    "age": { "type": "integer", "description": "The user's age." },
+                    "allow_duplicate": { "type": "boolean", "description": "Set to true only after the librarian confirmed that a similarly named existing user is a different person. Defaults to false." }
                 },
                 "required": ["full_name", "gender", "age"]
             }
         }
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "find_user",
+            "description": "Finds users by name, tolerating accents, word order, missing words and small typos. Returns the best matches first with user_id, full_name, gender, age, active_rentals and a match score from 0 to 1.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "name": { "type": "string", "description": "The user's name or part of it, e.g. 'Maria Lopez' or 'lopez'." },
+                    "limit": { "type": "integer", "description": "Maximum number of users to return (1-50). Defaults to 5." }
+                },
+                "required": ["name"]
+            }
+        }
+    },
     {
         "type": "function",
         "function": {
@@ -484,6 +3100,92 @@ if __name__ == "__main__":
             }
         }
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "search_books",
+            "description": "Ranked full-text search over book titles, authors and ISBNs. Matches word prefixes and tolerates typos. Returns the top matches with book_id, title, author, isbn and quantity in stock.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "query": { "type": "string", "description": "Words from the title, author or ISBN, e.g. 'quantum paradox' or 'reed'." },
+                    "limit": { "type": "integer", "description": "Maximum number of results to return (1-50). Defaults to 10." },
+                    "offset": { "type": "integer", "description": "Number of results to skip, used to fetch the next page. Defaults to 0." }
+                },
+                "required": ["query"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_books_by_author",
+            "description": "Lists the books written by an author (matching every word of the name, prefixes allowed), with book_id, title, isbn and quantity in stock.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "author": { "type": "string", "description": "The author's name or part of it, e.g. 'Nyx' or 'Evelyn Reed'." },
+                    "limit": { "type": "integer", "description": "Maximum number of books to return (1-200). Defaults to 50." }
+                },
+                "required": ["author"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_user_rental_summary",
+            "description": "Precomputed rental counts per user. With user_id returns that user's active and total rentals; without it returns the busiest users.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "user_id": { "type": "string", "description": "Optional user ID to look up, e.g. 'user_a1b2c3d4'." },
+                    "order_by": { "type": "string", "enum": ["active", "total"], "description": "Rank the busiest users by current ('active') or lifetime ('total') rentals. Defaults to 'active'." },
+                    "limit": { "type": "integer", "description": "Number of users to return when ranking (1-100). Defaults to 10." }
+                }
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_author_availability",
+            "description": "Precomputed per-author totals: number of titles, titles in stock, copies in stock and times rented. With author returns that author (exact or partial name); without it returns the most rented authors.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "author": { "type": "string", "description": "Optional author name, e.g. 'Gideon Ashworth'." },
+                    "limit": { "type": "integer", "description": "Number of authors to return (1-100). Defaults to 10." }
+                }
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_monthly_rentals",
+            "description": "Precomputed number of rentals and returns per calendar month (YYYY-MM), most recent first.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "months": { "type": "integer", "description": "How many months to return (1-120). Defaults to 12." }
+                }
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_popular_books",
+            "description": "The most rented books of all time, with current stock.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "limit": { "type": "integer", "description": "Number of books to return (1-100). Defaults to 10." }
+                }
+            }
+        }
+    },
     {
         "type": "function",
         "function": {
@@ -510,7 +3212,7 @@ if __name__ == "__main__":
         "type": "function",
         "function": {
             "name": "mass_execute",
-            "description": "Executes a list of SQL queries with their corresponding parameters in a single batch operation.",
+            "description": "Executes a list of SQL queries with their corresponding parameters in a single transaction. Consecutive operations with the same SQL are run together, so send repeated statements next to each other. Returns one status line per operation.",
             "parameters": {
                 "type": "object",
                 "properties": {
@@ -524,6 +3226,10 @@ if __name__ == "__main__":
                                 { "type": "array", "items": {} }
                             ]
                         }
+                    },
+                    "atomic": {
+                        "type": "boolean",
+                        "description": "If true, roll back every operation when any one of them fails. Defaults to false, which keeps the successful operations and reports the failed ones."
                     }
                 },
                 "required": ["operations"]
@@ -534,7 +3240,7 @@ if __name__ == "__main__":
         "type": "function",
         "function": {
             "name": "fetch_data",
-            "description": "Executes a read-only SQL SELECT query to fetch data. The query MUST use '?' placeholders for values in the WHERE clause to prevent injection.",
+            "description": "Executes a read-only SQL SELECT query to fetch data. The query MUST use '?' placeholders for values in the WHERE clause to prevent injection. Results come back one page at a time as CSV (header line first); if more rows exist, the last line contains a cursor to fetch the next page.",
             "parameters": {
                 "type": "object",
                 "properties": {
@@ -546,6 +3252,19 @@ if __name__ == "__main__":
                         "type": "array",
                         "description": "A list of parameters to substitute into placeholders. Provide an empty list [] if the prompt contains no placeholders.",
                         "items": {}
+                    },
+                    "limit": {
+                        "type": "integer",
+                        "description": "Maximum number of rows to return in this page (1-1000). Defaults to 200."
+                    },
+                    "cursor": {
+                        "type": "string",
+                        "description": "The cursor from the previous page's last line. Send it with the exact same prompt and params to get the next page."
+                    },
+                    "output_format": {
+                        "type": "string",
+                        "enum": ["csv", "jsonl"],
+                        "description": "'csv' (default) for a header line plus one line per row, or 'jsonl' for one JSON object per row."
                     }
                 },
                 "required": ["prompt", "params"]
@@ -553,14 +3272,74 @@ if __name__ == "__main__":
         }
     }
 ]
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="AI-powered library management CLI")
+    parser.add_argument("--import", dest="import_paths", metavar="PATH", action="append", default=[],
+                        help="bulk load a CSV or JSONL catalog dump into library.db and exit (repeatable)")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="stream responses token by token and run tool calls as soon as they arrive")
+    parser.add_argument("--fast-path", action="store_true",
+                        help="answer structured commands with IDs (e.g. 'return rent_ab12cd34') locally without calling the model")
+    parser.add_argument("--full-prompt", action="store_true",
+                        help="send the system prompt and tool descriptions verbatim instead of the compacted versions")
+    parser.add_argument("--select-tools", action="store_true",
+                        help="only send the tools that look relevant to each message, plus a few core lookups")
+    parser.add_argument("--serve", metavar="HOST:PORT", default=None,
+                        help="run a local HTTP/JSON API instead of the interactive prompt, e.g. 127.0.0.1:8080")
+    parser.add_argument("--server-workers", type=int, default=SERVER_CHAT_WORKERS,
+                        help="chat turns processed at once in server mode")
+    parser.add_argument("--server-queue", type=int, default=SERVER_QUEUE_SIZE,
+                        help="requests allowed to wait for a worker before the server answers 503")
+    parser.add_argument("--audit-log", metavar="PATH", default=AUDIT_LOG_PATH,
+                        help="JSON-lines audit log, appended to across restarts and rotated into gzip files by size")
+    parser.add_argument("--audit-max-bytes", type=int, default=AUDIT_MAX_BYTES,
+                        help="rotate the audit log once it reaches this size")
+    parser.add_argument("--audit-payload-chars", type=int, default=AUDIT_PAYLOAD_CHARS,
+                        help="cut tool arguments and results longer than this in the audit log")
+    parser.add_argument("--id-format", choices=("time", "random"), default="time",
+                        help="new IDs: 'time' for sortable ULID-style IDs (e.g. book_01j9z...), 'random' for the old 8-character ones")
+    parser.add_argument("--journal-mode", choices=("wal", "delete"), default="wal",
+                        help="SQLite journal mode; WAL lets several terminals share library.db without readers blocking writers")
+    parser.add_argument("--busy-timeout", type=float, default=BUSY_TIMEOUT_SECONDS,
+                        help="seconds to wait for another terminal's write lock before retrying")
+    parser.add_argument("--auth-window", type=float, default=AUTH_SESSION_SECONDS,
+                        help="seconds an admin password stays valid for execute_sql/mass_execute (0 asks every time)")
+    parser.add_argument("--auth-operations", type=int, default=AUTH_SESSION_OPERATIONS,
+                        help="privileged operations allowed per admin password entry")
+    parser.add_argument("--history-budget", type=int, default=HISTORY_TOKEN_BUDGET,
+                        help="approximate token budget for the conversation history sent on each request")
+    parser.add_argument("--history-archive", metavar="PATH", default=None,
+                        help="append trimmed conversation history to this JSONL file")
+    args = parser.parse_args()
+    start_audit_log(args.audit_log, max_bytes=args.audit_max_bytes, payload_chars=args.audit_payload_chars)
+
+    if args.import_paths:
+        with Librarian(ConnectionManager(journal_mode=args.journal_mode, busy_timeout=args.busy_timeout)) as librarian:
+            for path in args.import_paths:
+                print(librarian.bulk_import(path))
+        raise SystemExit(0)
+
     list_of_tools = [
         "get_current_date",
         "add_rental",
         "return_book",
+        "add_rentals_bulk",
+        "return_books_bulk",
+        "get_overdue_rentals",
+        "get_rentals_between",
         "add_user",
+        "find_user",
         "delete_user",
         "add_book",
         "delete_book",
+        "search_books",
+        "get_books_by_author",
+        "get_user_rental_summary",
+        "get_author_availability",
+        "get_monthly_rentals",
+        "get_popular_books",
         "execute_sql",
         "mass_execute",
         "fetch_data"
@@ -573,9 +3352,15 @@ Your capabilities are defined by the following tools, which you must use in this
 1. PREFERRED HIGH-LEVEL TOOLS (Use these first for ALL common tasks):
 
    - add_rental / return_book: Your primary tools for managing rentals. Use these instead of raw SQL.
+   - add_rentals_bulk / return_books_bulk: Use these instead of repeated add_rental / return_book calls whenever more than one rental or return is processed at once.
    - add_book / delete_book: Your primary tools for managing the book catalog.
    - add_user / delete_user: Your primary tools for managing user records.
+   - find_user: Your primary tool for finding a user by name (e.g., to get their user_id). Use it instead of querying the users table.
    - get_current_date: A utility to fetch today's date, which you MUST use for all new rentals and returns.
+   - get_overdue_rentals / get_rentals_between: Your primary tools for overdue rentals and rentals within a date range.
+   - search_books: Your primary tool for finding a book by title, author or ISBN (e.g., to get its book_id). Use it instead of fetching the whole catalog.
+   - get_books_by_author: Lists everything we hold by a given author.
+   - get_user_rental_summary / get_author_availability / get_monthly_rentals / get_popular_books: Precomputed statistics. Use these for "busiest users", "what is available from author X", rentals per month and "most rented books" instead of writing aggregate queries.
    - fetch_data: Your primary tool for answering ANY question about the library's data (e.g., "list all books", "who has book X?").
 
 
@@ -590,8 +3375,10 @@ RENTAL AND RETURN WORKFLOW (CRITICAL):
    1. Acknowledge the request. Ask for the user_id and book_id if they are not provided.
    2. Call `get_current_date` to get today's date.
    2.5. ASk the user for a name or book_title
-   use the book title to find it's id from the books table and the user_id from the users table
+   use the book title to find it's id with search_books and the user's name to find their user_id with find_user
+   if several users match, show them to the librarian and ask which one is meant
    if the user doesn't exist, ask the librarian to provide the rentee's full name, age, and gender
+   if add_user reports a possible duplicate, ask the librarian whether it is the same person before retrying with allow_duplicate
    3. Call `add_rental` using the user_id, book_id, and the date you just fetched.
    4. Report the outcome (success or error message) to the librarian.
 
@@ -625,20 +3412,44 @@ DATABASE SCHEMA REFERENCE:
    - books: (book_id, title, author, isbn, quantity, amount_of_times_rented)
    - users: (user_id, full_name, gender, age)
    - rentals: (rental_id, user_id, book_id, rental_date, return_date)
+   - rental_date and return_date are stored as YYYY-MM-DD text, so compare against that form in SQL. Query results display them as DD/MM/YYYY.
 
 ANSWERING SUGGESTIONS
-    - If the librarian asks a question, sucha s a suggestion, you MUST fetch all the title of all books in stock( You are to NEVER suggest books which are not in the databse), and use your own knowledge abaout said books to provide recomendations and suggestions
+    - If the librarian asks a question, sucha s a suggestion, you MUST look up the titles in stock( You are to NEVER suggest books which are not in the databse), and use your own knowledge abaout said books to provide recomendations and suggestions
+    - Use search_books with keywords from the request first. Only if that is not enough, list titles with fetch_data in pages of at most 50 (LIMIT/OFFSET) rather than the whole catalog
     - You will NEVER EVER mention ANY book that isn't in our database EVER!
 
 
 CRITICAL FORMATTING RULE:
 All of your responses MUST be plain text. Do NOT use any markdown formatting such as astrisks, underscores, etc. Use newlines, double newlines, and indentation to structure your output for maximum clarity in a command-line interface. If the user wishes to exit, they need ot press Ctrl+C'''
 
-    with Mistral_Ai(os.getenv("MISTRAL_KEY"), "mistral-large-latest", system_prompt, tools_json, list_of_tools) as mist_cli:
+    history = HistoryManager(token_budget=args.history_budget, archive_path=args.history_archive)
+    librarian = Librarian(ConnectionManager(journal_mode=args.journal_mode, busy_timeout=args.busy_timeout),
+                          auth=AuthorizationSession(args.auth_window, args.auth_operations, interactive=not args.serve),
+                          id_generator=TimeOrderedIdGenerator() if args.id_format == "time" else RandomIdGenerator())
+    with Mistral_Ai(os.getenv("MISTRAL_KEY"), "mistral-large-latest", system_prompt, TOOLS_JSON, list_of_tools, history=history, librarian=librarian, fast_path=args.fast_path,
+                    compact_prompt=not args.full_prompt, select_tools=args.select_tools) as mist_cli:
+        if args.serve:
+            host, _, port = args.serve.rpartition(":")
+            server = LibraryServer(mist_cli, host or "127.0.0.1", int(port), chat_workers=args.server_workers, queue_size=args.server_queue)
+            print(f"Serving the library API on http://{server.address[0]}:{server.address[1]} (Ctrl+C to stop)")
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                print("\nStopping the server...")
+            raise SystemExit(0)
         os.system("clear")
+        if args.use_async:
+            try:
+                asyncio.run(run_async_cli(mist_cli))
+            except (KeyboardInterrupt, EOFError):
+                print("\n<<Library Assistant>>:\n--------------------\nExiting...\n")
+            raise SystemExit(0)
         while True:
             try:
                 command = input("<<YOU>>: ")
+                if handle_cli_command(mist_cli, command):
+                    continue
                 print(f"\n<<Library Assistant>>:\n--------------------\n{mist_cli.text_gen(command)}\n")
                 continue
             except httpx.ConnectError: